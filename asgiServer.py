@@ -0,0 +1,348 @@
+# asyncio (ASGI) version of the /login and /register endpoints of
+# pythonServer.py, configured by the same environment variables. Protocol work
+# runs on an executor, never on the event loop. Logins (and registrations)
+# arriving within PASTA_WINDOW_MS of each other are coalesced into one batch:
+# one respond_batch() per server for the whole batch, then finalize() and one
+# verifyBatch(). A window of 0 runs each request on its own.
+#
+#   uvicorn asgiServer:app --port 5000
+#   python asgiServer.py --port 5000 --window 2
+#
+# Without uvicorn installed, asgiServer.py serves the app with a minimal
+# HTTP/1.1 server on asyncio streams, enough for GET requests and keep-alive.
+import argparse
+import asyncio
+import json
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from Crypto.Hash import SHA256
+from Crypto.Random.random import randrange, getrandbits
+
+import metrics
+import pasta
+from pasta import SecParam, CryptoError, keyCeremony, loadKeys
+
+KEY_FILE = os.environ.get('PASTA_KEYS', 'pasta_keys.json')
+if not os.path.exists(KEY_FILE):
+    print('No key file at {}, running key ceremony'.format(KEY_FILE))
+    keyCeremony(KEY_FILE, 512, 5, 4)
+shares, vk, pp = loadKeys(KEY_FILE)
+x = getrandbits(128)
+T = list(range(1, pp.t+1))
+
+if os.environ.get('PASTA_METRICS') == '1':
+    metrics.enable()
+
+SERVERS = os.environ.get('PASTA_SERVERS')
+pool = None
+if SERVERS:
+    from cluster import ServerPool, registerRemote, requestTkRemote
+    pool = ServerPool.fromList(SERVERS.split(','))
+
+if os.environ.get('PASTA_DB'):
+    pasta.openStores(os.environ['PASTA_DB'], range(1, pp.n+1))
+
+# PASTA_WORKERS runs per-server work on that many processes (see
+# pasta.startExecutor). The threads below only keep it off the event loop
+if os.environ.get('PASTA_WORKERS'):
+    pasta.startExecutor(vk, pp, int(os.environ['PASTA_WORKERS']))
+
+WINDOW = float(os.environ.get('PASTA_WINDOW_MS', '2')) / 1000 # seconds
+MAX_BATCH = int(os.environ.get('PASTA_MAX_BATCH', '64'))
+THREADS = ThreadPoolExecutor(max(pp.n, 4), thread_name_prefix='pasta')
+
+
+def clientId(username):
+    return int(SHA256.new(bytes(username, 'utf-8')).hexdigest(), 16)
+
+
+class Coalescer:
+    ''' Collects requests for up to `window` seconds, or until `maxBatch` are
+    waiting, and hands them to `run` as one batch
+    ``Args:``
+        run: (coroutine function) takes a list of items, returns a list of
+            results in the same order
+        window: (float) seconds to wait for more requests, 0 for none
+        maxBatch: (int) largest batch
+    '''
+    def __init__(self, run, window, maxBatch):
+        self.run = run
+        self.window = window
+        self.maxBatch = maxBatch
+        self.pending = []
+        self.timer = None
+        self.batches = 0
+
+    async def submit(self, item):
+        ''' Result for item, once its batch has run '''
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.maxBatch or self.window <= 0:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            self.batches += 1
+            asyncio.ensure_future(self.finish(batch))
+
+    async def finish(self, batch):
+        try:
+            results = await self.run([item for item, _ in batch])
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+def startLogins(logins):
+    ''' Client side of each login: contexts and request frames '''
+    out = []
+    for C, pwd in logins:
+        ctx = pasta.LoginContext(C, SecParam(pwd=pwd, rho=randrange(1, pp.opp.n)), pp)
+        req, st = ctx.request(T)
+        out.append((C, req, st))
+    return out
+
+
+def finishLogins(started, responses):
+    ''' Decrypt and combine each login's responses, then verify all tokens '''
+    tokens, where = [], []
+    for j, (C, req, st) in enumerate(started):
+        res = {i: responses[i][j] for i in T}
+        if any(resi is None for resi in res.values()):
+            continue # unknown client
+        try:
+            tokens.append((C, x, pasta.finalize(st, res, pp, C, x)))
+            where.append(j)
+        except CryptoError:
+            pass # wrong password, the responses do not decrypt
+    valid = [False] * len(started)
+    for j, ok in zip(where, pasta.verifyBatch(vk, tokens, pp)):
+        valid[j] = ok
+    return valid
+
+
+async def loginBatch(logins):
+    ''' Run a batch of (C, pwd) logins, returns a bool for each '''
+    loop = asyncio.get_running_loop()
+    if pool is not None:
+        # Protocol servers answer one login per request, so no batching
+        def remote(C, pwd):
+            try:
+                sec = SecParam(pwd=pwd, rho=randrange(1, pp.opp.n))
+                return pasta.verifyTk(vk, C, x, requestTkRemote(C, sec, vk, pp, x, pool), pp)
+            except CryptoError:
+                return False
+        return await asyncio.gather(*(loop.run_in_executor(THREADS, remote, C, pwd)
+                                      for C, pwd in logins))
+
+    started = await loop.run_in_executor(THREADS, startLogins, logins)
+    # One respond_batch() per server, all at once
+    batches = [[(C, x, req[i]) for C, req, st in started] for i in T]
+    replies = await asyncio.gather(*(
+        loop.run_in_executor(THREADS, pasta.respond_batch, i, shares[i-1], batch, vk, pp)
+        for i, batch in zip(T, batches)))
+    return await loop.run_in_executor(THREADS, finishLogins, started, dict(zip(T, replies)))
+
+
+def registerLocal(users):
+    ''' Store the users that are new, already registered ones (or repeats
+    within the batch) keep their password and get False '''
+    new, seen = [], set()
+    for C, pwd in users:
+        new.append(C not in seen and not pasta.registered(C, pp))
+        seen.add(C)
+    # The check above only saves signing up known users. A batch running at
+    # the same time can store the same C first, so the answer comes from
+    # the stores
+    todo = [j for j, ok in enumerate(new) if ok]
+    stored = pasta.storeEach(pasta.signUpBatch([users[j] for j in todo], pp), pp)
+    for j, ok in zip(todo, stored):
+        new[j] = ok
+    return new
+
+
+async def registerBatch(users):
+    ''' Sign up and store a batch of (C, pwd), returns a bool for each '''
+    loop = asyncio.get_running_loop()
+    if pool is None:
+        return await loop.run_in_executor(THREADS, registerLocal, users)
+
+    def remote(C, pwd):
+        try:
+            registerRemote(C, SecParam(pwd=pwd, rho=randrange(1, pp.opp.n)), pp, pool)
+            return True
+        except Exception:
+            return False
+    return await asyncio.gather(*(loop.run_in_executor(THREADS, remote, C, pwd)
+                                  for C, pwd in users))
+
+
+coalescers = {} # made on first use, inside the server's event loop
+
+
+def coalescer(name, run):
+    if name not in coalescers:
+        coalescers[name] = Coalescer(run, WINDOW, MAX_BATCH)
+    return coalescers[name]
+
+
+async def sendBody(send, status, body, contentType):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', contentType),
+                            (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def app(scope, receive, send):
+    ''' The ASGI application '''
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                pasta.closeStores()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    if scope['method'] != 'GET' or path not in ('/login', '/register', '/metrics'):
+        await sendBody(send, 404, b'not found\n', b'text/plain')
+        return
+    if path == '/metrics':
+        await sendBody(send, 200, metrics.render().encode(), b'text/plain; version=0.0.4')
+        return
+
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    username = query.get('username', [None])[0]
+    password = query.get('password', [None])[0]
+    result, status = False, 200
+    if username is not None and password is not None:
+        C = clientId(username)
+        if path == '/login':
+            # A failed batch fails every login in it, each is answered here
+            try:
+                result = await coalescer('login', loginBatch).submit((C, password))
+            except CryptoError:
+                result = False
+            except Exception:
+                result, status = False, 500
+        else:
+            try:
+                result = await coalescer('register', registerBatch).submit((C, password))
+            except Exception:
+                result = False
+    await sendBody(send, status, json.dumps(result).encode() + b'\n', b'application/json')
+
+
+async def handleConnection(reader, writer):
+    ''' One HTTP/1.1 connection of the built-in server, requests in turn '''
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                return
+            lines = head.decode('latin-1').split('\r\n')
+            try:
+                method, target, version = lines[0].split(' ')
+            except ValueError:
+                return
+            headers = [tuple(line.split(':', 1)) for line in lines[1:] if ':' in line]
+            headers = [(k.strip().lower(), v.strip()) for k, v in headers]
+            fields = dict(headers)
+            body = await reader.readexactly(int(fields.get('content-length', 0)))
+            path, _, query = target.partition('?')
+            scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': version[5:],
+                     'method': method, 'path': path, 'raw_path': path.encode(),
+                     'query_string': query.encode('latin-1'), 'root_path': '',
+                     'scheme': 'http', 'server': writer.get_extra_info('sockname'),
+                     'client': writer.get_extra_info('peername'),
+                     'headers': [(k.encode(), v.encode()) for k, v in headers]}
+
+            async def receive():
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+
+            response = {}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    response['start'] = message
+                else:
+                    response.setdefault('body', []).append(message.get('body', b''))
+
+            await app(scope, receive, send)
+            data = b''.join(response.get('body', []))
+            close = fields.get('connection', '').lower() == 'close' or version == 'HTTP/1.0'
+            out = ['HTTP/1.1 {} {}'.format(response['start']['status'],
+                                           'OK' if response['start']['status'] == 200 else 'Error')]
+            out += ['{}: {}'.format(k.decode(), v.decode()) for k, v in response['start']['headers']]
+            out.append('Connection: ' + ('close' if close else 'keep-alive'))
+            writer.write(('\r\n'.join(out) + '\r\n\r\n').encode('latin-1') + data)
+            await writer.drain()
+            if close:
+                return
+    except (asyncio.CancelledError, ConnectionError):
+        pass # shutting down, or the client went away
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    ''' Run the built-in server until SIGINT or SIGTERM '''
+    server = await asyncio.start_server(handleConnection, host, port, backlog=1024)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    print('Serving on http://{}:{} (window {:g} ms, batches up to {})'.format(
+        host, port, WINDOW * 1000, MAX_BATCH), flush=True)
+    async with server:
+        await stop.wait()
+
+
+def main():
+    global WINDOW, MAX_BATCH
+    parser = argparse.ArgumentParser(description='asyncio PASTA front-end with request coalescing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--window', type=float, default=WINDOW * 1000,
+                        help='coalescing window in ms, 0 to run each request on its own')
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH, help='largest batch')
+    parser.add_argument('--builtin', action='store_true',
+                        help='use the built-in HTTP server even if uvicorn is installed')
+    args = parser.parse_args()
+    WINDOW, MAX_BATCH = args.window / 1000, args.max_batch
+
+    try:
+        if args.builtin:
+            raise ImportError
+        import uvicorn
+    except ImportError:
+        try:
+            asyncio.run(serve(args.host, args.port))
+        finally:
+            pasta.closeStores()
+        return
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Scaling benchmark for the parallel executor in pasta.py. Runs the same
+# logins with no executor, then with 1..N workers, and reports the latency
+# of a single login and the throughput of many concurrent ones.
+#
+#   python benchParallel.py -k 1024 --prove
+#   python benchParallel.py -k 2048 --max-workers 8 --logins 64 --kind thread
+import argparse
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from Crypto.Random.random import getrandbits, randrange
+
+import pasta
+from pasta import SecParam, globalSetup, signUp, store, requestTk, verifyTk
+
+
+def run(args, users, shares, vk, pp, x):
+    ''' Median single-login latency (s) and concurrent logins per second '''
+    T = list(range(1, pp.t+1))
+    C, sec = users[0]
+    lat = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        tk = requestTk(C, sec, shares, vk, pp, T, x, args.prove)
+        lat.append(time.perf_counter() - start)
+        assert verifyTk(vk, C, x, tk, pp)
+
+    def login(user):
+        return requestTk(user[0], user[1], shares, vk, pp, T, x, args.prove)
+
+    with ThreadPoolExecutor(args.clients) as clients:
+        start = time.perf_counter()
+        list(clients.map(login, users))
+        elapsed = time.perf_counter() - start
+    return statistics.median(lat), len(users) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling benchmark for pasta.startExecutor')
+    parser.add_argument('-k', type=int, default=1024, help='RSA prime size in bits')
+    parser.add_argument('-n', type=int, default=5, help='number of servers')
+    parser.add_argument('-t', type=int, default=4, help='threshold')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count(),
+                        help='largest worker count to try (default: all cores)')
+    parser.add_argument('--kind', choices=('process', 'thread'), default=None,
+                        help='executor kind (default: process, thread without the GIL)')
+    parser.add_argument('--prove', action='store_true', help='ask for and check proofs')
+    parser.add_argument('--logins', type=int, default=32, help='logins in the throughput run')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--repeat', type=int, default=5, help='latency samples')
+    args = parser.parse_args()
+
+    shares, vk, pp = globalSetup(args.k, args.n, args.t)
+    x = getrandbits(128)
+    users = []
+    for _ in range(args.logins):
+        C = getrandbits(256)
+        sec = SecParam(pwd=hex(getrandbits(64)), rho=randrange(1, pp.opp.n))
+        store(C, signUp(C, sec, pp), pp)
+        users.append((C, sec))
+
+    print('{} bit, n={}, t={}, prove={}, {} cores, GIL {}'.format(
+        args.k, args.n, args.t, args.prove, os.cpu_count(),
+        'on' if pasta.gilEnabled() else 'off'))
+    print('{:>8} {:>12} {:>12} {:>8}'.format('workers', 'latency ms', 'logins/s', 'speedup'))
+
+    lat, rate = run(args, users, shares, vk, pp, x)
+    base = rate
+    print('{:>8} {:>12.1f} {:>12.1f} {:>8.2f}'.format('serial', lat * 1e3, rate, 1.0))
+    for workers in range(1, args.max_workers + 1):
+        pasta.startExecutor(vk, pp, workers, args.kind)
+        lat, rate = run(args, users, shares, vk, pp, x)
+        print('{:>8} {:>12.1f} {:>12.1f} {:>8.2f}'.format(workers, lat * 1e3, rate, rate / base))
+    pasta.stopExecutor()
+
+
+if __name__ == '__main__':
+    main()
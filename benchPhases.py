@@ -0,0 +1,249 @@
+# Benchmark of every protocol phase and the primitives underneath, over key
+# sizes, (n, t) pairs and cold or warm caches. Results are saved as a JSON
+# baseline, and a later run can be compared against it to catch regressions.
+#
+#   python benchPhases.py --save baseline.json
+#   python benchPhases.py --compare baseline.json --tolerance 0.15
+#   python benchPhases.py -k 512 1024 --nt 5:4 --repeat 3
+#   python benchPhases.py --dealer -k 1024
+#
+# --dealer times the TTG dealer (shoup.setup with a prebuilt Zn) and a warm
+# combine of the last t servers for n in 5 16 64 256 with t = n/2+1 instead,
+# and reports their largest Lagrange coefficient and the combined exponent
+# eprime in bits.
+#
+# Cold runs clear the hash and Lagrange coefficient caches in ttg/znUtil.py
+# before every sample, warm runs fill them first. Inputs come from a seeded
+# generator, so runs time the same work. --compare exits with 1 if any
+# benchmark got slower by more than the tolerance, comparing minimum times by
+# default as they are the least noisy. On a shared or busy machine use more
+# repeats and a wider tolerance, or --normalize, which scales the new times by
+# how much faster or slower a fixed calibration workload ran.
+import argparse
+import itertools
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+import pasta
+import top.TOP as top
+import ttg.shoup as shoup
+import ttg.znUtil as znUtil
+from pasta import SecParam
+
+MODES = ('cold', 'warm')
+
+
+def clearCaches():
+    znUtil.hashToZn.cache_clear()
+    znUtil.lamb_coeffs.cache_clear()
+
+
+def measure(fn, repeat, mode):
+    ''' Median and minimum time of fn() in ms '''
+    if mode == 'warm':
+        fn()
+    samples = []
+    for _ in range(repeat):
+        if mode == 'cold':
+            clearCaches()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {'median_ms': statistics.median(samples) * 1e3, 'min_ms': min(samples) * 1e3}
+
+
+def calibrate(repeat):
+    ''' Time of a fixed big-integer workload, a yardstick for machine speed '''
+    rng = random.Random(0)
+    m = rng.getrandbits(1024) | 1
+    b, e = rng.getrandbits(1024), rng.getrandbits(1024)
+    return measure(lambda: [pow(b + j, e, m) for j in range(10)], repeat, 'cold')['min_ms']
+
+
+def benchCurve(rng, repeat):
+    ''' Primitives that only depend on the curve '''
+    k = rng.randrange(1, top.curve.n)
+    g = top.Point(*top.curve.g)
+    # The same inputs every run, as the search in getPoint depends on them
+    inputs = [rng.getrandbits(256) for _ in range(repeat)]
+    cipolla, sqrt = itertools.cycle(inputs), itertools.cycle(inputs)
+    return {
+        'curve/scalar_mult': measure(lambda: top.scalar_mult(k, g), repeat, 'cold'),
+        'curve/scalar_mult_wnaf': measure(lambda: top.scalar_mult_wnaf(k, g), repeat, 'cold'),
+        'curve/getPoint': measure(lambda: top.getPoint(next(cipolla)), repeat, 'cold'),
+        'curve/getPointSqrt': measure(lambda: top.getPointSqrt(next(sqrt)), repeat, 'cold'),
+    }
+
+
+def benchConfig(seed, k, n, t, repeat, modes):
+    ''' All phases for one key size and (n, t) '''
+    prefix = 'k={}/n={}/t={}'.format(k, n, t)
+    # Seeded per configuration, so inputs do not depend on which others run
+    rng = random.Random('{}/{}'.format(seed, prefix))
+    results = {prefix + '/cold/globalSetup':
+               measure(lambda: pasta.globalSetup(k, n, t), max(1, repeat // 2), 'cold')}
+    shares, vk, pp = pasta.globalSetup(k, n, t)
+
+    C = rng.getrandbits(256)
+    x = rng.getrandbits(128)
+    sec = SecParam(pwd='benchmark', rho=rng.randrange(1, pp.opp.n))
+    pasta.store(C, pasta.signUp(C, sec, pp), pp)
+
+    T = list(range(1, t+1))
+    ctx = pasta.LoginContext(C, sec, pp)
+    req, st = ctx.request(T)
+    res = {i: pasta.respond(i, shares[i-1], C, x, req[i], vk, pp) for i in T}
+    proved = {i: pasta.respond(i, shares[i-1], C, x, req[i], vk, pp, True) for i in T}
+    tk = pasta.finalize(st, res, pp, C, x)
+
+    concat = bytes(str(C) + str(x), 'utf-8')
+    parts = [shoup.partEval(shares[i-1], vk, concat, pp.tpp) for i in T]
+
+    phases = {
+        'signUp': lambda: pasta.signUp(C, sec, pp),
+        'request': lambda: pasta.LoginContext(C, sec, pp).request(T),
+        'respond': lambda: pasta.respond(1, shares[0], C, x, req[1], vk, pp),
+        'respond_proof': lambda: pasta.respond(1, shares[0], C, x, req[1], vk, pp, True),
+        'finalize': lambda: pasta.finalize(st, res, pp, C, x),
+        'finalize_proof': lambda: pasta.finalize(st, proved, pp, C, x, vk),
+        'verify': lambda: pasta.verify(vk, C, x, tk, pp),
+        'partEval': lambda: shoup.partEval(shares[0], vk, concat, pp.tpp),
+        'combine': lambda: shoup.combine(parts, pp.tpp, t, concat),
+    }
+    for mode in modes:
+        for name, fn in phases.items():
+            results['{}/{}/{}'.format(prefix, mode, name)] = measure(fn, repeat, mode)
+    return results
+
+
+def benchDealer(k, n, repeat):
+    ''' Dealer and combine for one key size and n, with t = n/2+1 '''
+    t = n // 2 + 1
+    prefix = 'dealer/k={}/n={}/t={}'.format(k, n, t)
+    # setup() drops the dealer secrets, so every sample deals from its own Zn,
+    # built outside the timer
+    samples = []
+    for _ in range(repeat):
+        G = znUtil.Zn(n, k)
+        start = time.perf_counter()
+        shares, vk, pp = shoup.setup(k, n, t, G)
+        samples.append(time.perf_counter() - start)
+    results = {prefix + '/setup': {'median_ms': statistics.median(samples) * 1e3,
+                                   'min_ms': min(samples) * 1e3}}
+
+    # Servers n-t+1..n, whose coefficients are larger than those of 1..t
+    delta, G = pp
+    x = b'benchmark'
+    S = tuple(range(n - t + 1, n + 1))
+    parts = [shoup.partEval(shares[i-1], vk, x, pp) for i in S]
+    results[prefix + '/combine'] = measure(lambda: shoup.combine(parts, pp, t, x), repeat, 'warm')
+    coeffs, eprime, _ = znUtil.lamb_coeffs(S, delta, G.e)
+    print('n={:<4} t={:<4} setup {:9.2f} ms  combine {:9.2f} ms  '
+          'largest coefficient {:5} bits  eprime {:5} bits'.format(
+              n, t, results[prefix + '/setup']['median_ms'],
+              results[prefix + '/combine']['median_ms'],
+              max(abs(c) for c in coeffs).bit_length(), eprime.bit_length()))
+    return results
+
+
+def compare(baseline, results, tolerance, stat='min_ms', scale=1.0):
+    ''' Print new vs baseline times, returns the names of regressions.
+    New times are multiplied by scale first '''
+    regressions = []
+    print('{:<40} {:>11} {:>11} {:>8}'.format('benchmark', 'base ms', 'new ms', 'change'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name][stat]
+        new = results[name][stat] * scale
+        change = new / old - 1 if old else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{:<40} {:>11.3f} {:>11.3f} {:>+7.1%}{}'.format(name, old, new, change, flag))
+    missing = sorted(set(baseline) - set(results))
+    if missing:
+        print('{} baseline benchmarks were not run'.format(len(missing)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PASTA phases and primitives')
+    parser.add_argument('-k', type=int, nargs='+', default=[512, 1024, 2048],
+                        help='RSA prime sizes in bits')
+    parser.add_argument('--nt', nargs='+', default=['3:2', '5:4', '10:7'],
+                        help='n:t pairs')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES),
+                        help='cache states to measure')
+    parser.add_argument('--repeat', type=int, default=5, help='samples per benchmark')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed slowdown before a benchmark is flagged (0.10 = 10%%)')
+    parser.add_argument('--stat', choices=('min_ms', 'median_ms'), default='min_ms',
+                        help='statistic compared against the baseline')
+    parser.add_argument('--seed', type=int, default=5471, help='seed for benchmark inputs')
+    parser.add_argument('--normalize', action='store_true',
+                        help='scale times by the calibration ratio before comparing')
+    parser.add_argument('--dealer', type=int, nargs='*', metavar='N',
+                        help='benchmark the dealer and combine for these n instead '
+                        '(default 5 16 64 256), t = n/2+1')
+    args = parser.parse_args()
+
+    pairs = [tuple(int(v) for v in nt.split(':')) for nt in args.nt]
+    calibration = calibrate(args.repeat)
+    if args.dealer is not None:
+        results = {}
+        for k in args.k:
+            print('k={}'.format(k))
+            for n in args.dealer or [5, 16, 64, 256]:
+                results.update(benchDealer(k, n, args.repeat))
+    else:
+        results = benchCurve(random.Random(args.seed), args.repeat)
+        for k in args.k:
+            for n, t in pairs:
+                sys.stderr.write('k={} n={} t={}\n'.format(k, n, t))
+                results.update(benchConfig(args.seed, k, n, t, args.repeat, args.modes))
+
+    if args.save:
+        data = {
+            'meta': {
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'machine': platform.machine(),
+                'platform': platform.platform(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'repeat': args.repeat,
+                'seed': args.seed,
+                'calibration_ms': calibration,
+            },
+            'results': results,
+        }
+        with open(args.save, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            data = json.load(f)
+        scale = 1.0
+        if args.normalize:
+            scale = data['meta']['calibration_ms'] / calibration
+            print('Calibration {:.1f} ms vs {:.1f} ms in the baseline, scaling by {:.2f}'.format(
+                calibration, data['meta']['calibration_ms'], scale))
+        regressions = compare(data['results'], results, args.tolerance, args.stat, scale)
+        if regressions:
+            print('{} regressions beyond {:.0%}'.format(len(regressions), args.tolerance))
+            sys.exit(1)
+        print('No regressions beyond {:.0%}'.format(args.tolerance))
+    elif not args.save and args.dealer is None:
+        for name in sorted(results):
+            print('{:<40} {:>11.3f} ms'.format(name, results[name]['median_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# Client side of a PASTA deployment where each protocol server runs as its own
+# HTTP service (see protocolServer.py). Requests go to all n servers at once
+# over pooled keep-alive connections, and a login finishes as soon as t valid
+# responses are in, so its latency is set by the t-th fastest server.
+import collections
+import http.client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeout
+from urllib.parse import urlsplit
+
+import wire
+from pasta import CryptoError, BadServerError, LoginContext, signUp, finalize
+
+
+class ServerPool:
+    ''' Keep-alive HTTP connections to the protocol servers
+    ``Args:``
+        urls: (dict) i: base URL of server i, e.g. 'http://127.0.0.1:5001'
+        timeout: (float) socket timeout of one request, in seconds
+        workers: (int) threads used to fan requests out, default 4 per server
+    '''
+    def __init__(self, urls, timeout=5.0, workers=None):
+        self.urls = dict(urls)
+        self.timeout = timeout
+        self.addrs = {i: urlsplit(u) for i, u in self.urls.items()}
+        # deque append/pop are atomic, so the idle lists need no lock
+        self.idle = {i: collections.deque() for i in self.urls}
+        self.executor = ThreadPoolExecutor(workers or 4 * len(self.urls))
+
+    @classmethod
+    def fromList(cls, urls, **kwargs):
+        ''' Pool over a list of URLs, server i at position i-1 '''
+        return cls({i: u for i, u in enumerate(urls, 1)}, **kwargs)
+
+    def connect(self, i):
+        addr = self.addrs[i]
+        return http.client.HTTPConnection(addr.hostname, addr.port, timeout=self.timeout)
+
+    def post(self, i, path, body):
+        ''' POST body to server i
+        ``Returns``
+            (bytes) response body
+        ``Raises``
+            CryptoError: server answered with an error status
+            OSError, http.client.HTTPException: server unreachable
+        '''
+        headers = {'Content-Type': 'application/octet-stream'}
+        try:
+            conn, pooled = self.idle[i].pop(), True
+        except IndexError:
+            conn, pooled = self.connect(i), False
+        while True:
+            try:
+                conn.request('POST', path, body, headers)
+                res = conn.getresponse()
+                data = res.read()
+                break
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                # An idle connection may have been dropped by the server,
+                # retry once on a fresh one
+                if not pooled:
+                    raise
+                conn, pooled = self.connect(i), False
+
+        if res.will_close:
+            conn.close()
+        else:
+            self.idle[i].append(conn)
+        if res.status not in (200, 201):
+            raise CryptoError(res.status)
+        return data
+
+    def fanout(self, path, bodies):
+        ''' POST to several servers concurrently
+        ``Args:``
+            path: (str) request path
+            bodies: (dict) i: body for server i
+        ``Returns``
+            (dict) future: i, for use with as_completed
+        '''
+        return {self.executor.submit(self.post, i, path, body): i
+                for i, body in bodies.items()}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for conns in self.idle.values():
+            while conns:
+                conns.pop().close()
+
+
+def registerRemote(C, secrets, pp, pool):
+    ''' Register a client with every server in the pool
+    Every server is asked whether it knows C before any record is sent, so a
+    refused registration leaves nothing behind. A server that cannot answer
+    may hold an older record, so all of them have to.
+    ``Args:``
+        C: (int) Client ID
+        secrets: (`SecParam`) client secrets
+        pp: (`PubParam`) global public parameters
+        pool: (`ServerPool`) protocol servers
+    ``Returns``
+        (list) indices of the servers that hold the record
+    ``Raises``
+        CryptoError: C is already registered with some server, which keeps
+            its old record, some server could not be asked, or fewer than t
+            servers hold the record
+    '''
+    futures = pool.fanout('/known', {i: wire.encodeInt(C, wire.ID_SIZE) for i in pool.urls})
+    known, unreachable = [], []
+    for fut in as_completed(futures):
+        try:
+            if wire.decodeInt(fut.result()):
+                known.append(futures[fut])
+        except (CryptoError, OSError, http.client.HTTPException):
+            unreachable.append(futures[fut])
+    if known:
+        raise CryptoError('client already registered with servers {}'.format(sorted(known)))
+    if unreachable:
+        raise CryptoError('could not check servers {}'.format(sorted(unreachable)))
+
+    msg_dict = signUp(C, secrets, pp)
+    futures = pool.fanout('/store', {i: wire.encodeRecord(C, msg_dict[i]) for i in pool.urls})
+    stored, known = [], []
+    for fut in as_completed(futures):
+        try:
+            added = wire.decodeInt(fut.result())
+        except (CryptoError, OSError, http.client.HTTPException):
+            continue
+        (stored if added else known).append(futures[fut])
+    # Only a registration of the same C racing this one gets here
+    if known:
+        raise CryptoError('client already registered with servers {}'.format(sorted(known)))
+    if len(stored) < pp.t:
+        raise CryptoError
+    return sorted(stored)
+
+
+def requestTkRemote(C, secrets, vk, pp, x, pool, prove=True, timeout=None):
+    ''' Get a token from the first t servers in the pool to answer validly
+    The request goes to every server. Responses are handed to finalize() as
+    they arrive, once t of them are in. Servers that turn out to be bad are
+    dropped and their places taken by later responses.
+    ``Args:``
+        C: (int) Client ID
+        secrets: (`SecParam`) client secrets
+        vk: (`shoup.VerKey`) verification key
+        pp: (`PubParam`) global public parameters
+        x: (int) nonce
+        pool: (`ServerPool`) protocol servers
+        prove: (bool) ask for and check proofs of the partial tokens
+        timeout: (float) `optional` give up after this many seconds
+    ``Returns``
+        tk: (int) token
+    ``Raises``
+        CryptoError: fewer than t valid responses
+    '''
+    ctx = LoginContext(C, secrets, pp)
+    reqi = wire.encodeRequest(C, ctx.blinded)
+    path = '/respond?x={:x}&prove={:d}'.format(x, prove)
+    futures = pool.fanout(path, {i: reqi for i in pool.urls})
+
+    verified, pending = {}, {}
+    try:
+        for fut in as_completed(futures, timeout):
+            try:
+                pending[futures[fut]] = fut.result()
+            except (CryptoError, OSError, http.client.HTTPException):
+                continue
+            if len(verified) + len(pending) < pp.t:
+                continue
+            try:
+                return finalize((ctx, list(pending)), pending, pp, C, x,
+                                vk if prove else None, verified)
+            except BadServerError as err:
+                verified, pending = err.good, {}
+    except FutureTimeout:
+        pass
+    finally:
+        # Stragglers that have not been sent yet are not needed
+        for fut in futures:
+            fut.cancel()
+    raise CryptoError
@@ -0,0 +1,159 @@
+# Bulk enrollment of existing accounts. Users are read from a CSV file of
+# username,password lines as a stream, signed up in batches on worker
+# processes (pasta.signUpBatch) and written to the servers' record stores one
+# transaction per batch. A checkpoint after every stored batch lets an
+# interrupted run carry on where it stopped.
+#
+#   python enroll.py pasta_keys.json users.csv --db records/
+#   python enroll.py pasta_keys.json users.csv --servers http://a:5001,http://b:5002,...
+import argparse
+import collections
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+
+from Crypto.Hash import SHA256
+
+import pasta
+import wire
+
+
+def clientId(username):
+    ''' Client ID C of a username, as pythonServer.py computes it '''
+    return int(SHA256.new(bytes(username, 'utf-8')).hexdigest(), 16)
+
+
+def readUsers(path):
+    ''' Yields (C, pwd) for each username,password line of a CSV file '''
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if row:
+                yield clientId(row[0]), row[1]
+
+
+def loadCheckpoint(path, source):
+    ''' Number of users of source already enrolled, 0 without a checkpoint '''
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return 0
+    if data['source'] != source:
+        raise ValueError('checkpoint {} is for {}'.format(path, data['source']))
+    return data['done']
+
+
+def saveCheckpoint(path, source, done):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'source': source, 'done': done}, f)
+    os.replace(tmp, path)
+
+
+def localSink(pp):
+    ''' Write batches to the stores in pasta.serverDict '''
+    return lambda batch: pasta.storeMany(batch, pp)
+
+
+def remoteSink(pool):
+    ''' Write batches to protocol servers, one /store request per server '''
+    def sink(batch):
+        bodies = {i: b''.join(wire.encodeRecord(C, msg[i]) for C, msg in batch)
+                  for i in pool.urls}
+        for fut in as_completed(pool.fanout('/store', bodies)):
+            fut.result()
+    return sink
+
+
+def enroll(users, pp, sink, batchSize=1000, workers=None, h2c='sqrt', skip=0, done=None):
+    ''' Sign up a stream of users
+    At most two batches per worker are in flight, so memory does not grow
+    with the number of users. Batches are stored in input order.
+    ``Args:``
+        users: (iterable) of (C, pwd) tuples
+        pp: (`PubParam`) global public parameters
+        sink: (callable) stores the (C, msg_dict) list of one batch
+        batchSize: (int) users per batch
+        workers: (int) `optional` worker processes, default all cores
+        h2c: (str) hash-to-curve method, see pasta.signUp()
+        skip: (int) users at the start of the stream that are already enrolled
+        done: (callable) `optional` called with the number of users enrolled
+            so far (skipped ones included) after each stored batch
+    ``Returns``
+        (int) number of users enrolled, skipped ones included
+    '''
+    users = iter(users)
+    collections.deque(islice(users, skip), maxlen=0)
+    count = skip
+    workers = workers or os.cpu_count() or 1
+
+    with ProcessPoolExecutor(workers, initializer=pasta.initWorker,
+                             initargs=(None, pp, dict(pasta.serverKeyDict))) as pool:
+        inflight = collections.deque()
+        while True:
+            batch = list(islice(users, batchSize))
+            if batch:
+                inflight.append(pool.submit(pasta.signUpTask, batch, h2c))
+            while inflight and (len(inflight) >= 2 * workers or not batch):
+                records = inflight.popleft().result()
+                sink(records)
+                count += len(records)
+                if done:
+                    done(count)
+            if not batch:
+                return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enroll users in bulk')
+    parser.add_argument('keys', help='key file written by keygen.py')
+    parser.add_argument('users', help='CSV file of username,password lines')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--db', help='record store directory, as for protocolServer.py --db')
+    target.add_argument('--servers', help='comma separated URLs of protocol servers 1..n')
+    parser.add_argument('--batch', type=int, default=1000, help='users per batch')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--h2c', default='sqrt', help='hash-to-curve method')
+    parser.add_argument('--checkpoint', default=None,
+                        help='progress file to resume from (default: <users>.checkpoint)')
+    args = parser.parse_args()
+
+    shares, vk, pp = pasta.loadKeys(args.keys)
+    if args.db:
+        pasta.openStores(args.db, range(1, pp.n+1))
+        sink = localSink(pp)
+    else:
+        from cluster import ServerPool
+        sink = remoteSink(ServerPool.fromList(args.servers.split(',')))
+
+    source = os.path.abspath(args.users)
+    checkpoint = args.checkpoint or args.users + '.checkpoint'
+    skip = loadCheckpoint(checkpoint, source)
+    start = time.time()
+
+    def done(count):
+        saveCheckpoint(checkpoint, source, count)
+        elapsed = time.time() - start
+        sys.stderr.write('\r{} users, {:.0f} users/s'.format(count, (count - skip) / elapsed))
+        sys.stderr.flush()
+
+    try:
+        count = enroll(readUsers(args.users), pp, sink, args.batch, args.workers,
+                       args.h2c, skip, done)
+    except KeyboardInterrupt:
+        sys.exit('\nInterrupted, run again with the same checkpoint to resume')
+    finally:
+        pasta.closeStores()
+    elapsed = time.time() - start
+    sys.stderr.write('\n')
+    print('Enrolled {} users ({} resumed from checkpoint) in {:.1f}s, {:.0f} users/s'.format(
+        count - skip, skip, elapsed, (count - skip) / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# Key ceremony: generate the RSA shares, verification key, public parameters
+# and per-server 'keys' ki once, and save them for pythonServer.py to load.
+# Each protocol server gets its own file next to it, holding only its share
+# and ki (pasta_keys.server<i>.json, see protocolServer.py).
+#
+#   python keygen.py pasta_keys.json -k 2048 -n 5 -t 4
+#   python keygen.py pasta_keys.json -k 3072 --workers 8 --deadline 3600
+import argparse
+import sys
+import time
+
+from pasta import keyCeremony, serverKeyPath
+from ttg.znUtil import Zn
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the PASTA key ceremony')
+    parser.add_argument('path', help='key file to write')
+    parser.add_argument('-k', type=int, default=512, help='RSA prime size in bits')
+    parser.add_argument('-n', type=int, default=5, help='number of servers')
+    parser.add_argument('-t', type=int, default=4, help='threshold')
+    parser.add_argument('--fresh', action='store_true',
+                        help='generate new safe primes even for 512/1024/2048 bits')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes for safe prime search (default: all cores)')
+    parser.add_argument('--deadline', type=float, default=None,
+                        help='give up on safe prime search after this many seconds')
+    args = parser.parse_args()
+
+    def progress(tested, elapsed):
+        sys.stderr.write('\r{} candidates tested, {:.0f}s'.format(tested, elapsed))
+        sys.stderr.flush()
+
+    start = time.time()
+    G = Zn(args.n, args.k, fresh=args.fresh, workers=args.workers,
+           deadline=args.deadline, progress=progress)
+    sys.stderr.write('\n')
+    keyCeremony(args.path, args.k, args.n, args.t, G)
+    print('Wrote {} and {} .. {} ({} bit, n={}, t={}) in {:.2f}s'.format(
+        args.path, serverKeyPath(args.path, 1), serverKeyPath(args.path, args.n),
+        args.k, args.n, args.t, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
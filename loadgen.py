@@ -0,0 +1,437 @@
+# Load generator for the /register and /login endpoints of pythonServer.py (or
+# asgiServer.py with --server asgi). Starts the server on this machine (or uses
+# --url), registers a pool of users, then drives a mix of registrations, logins
+# and logins with a wrong password, either closed loop (--concurrency clients
+# back to back) or open loop (--rate arrivals per second, whether or not
+# earlier requests are done).
+#
+#   python loadgen.py --keys pasta_keys.json --duration 30 --concurrency 8
+#   python loadgen.py --rate 20 --duration 60 --invalid 0.2 --save run.json --hgrm run
+#   python loadgen.py --url http://127.0.0.1:5000 --rate 20 --compare run.json
+#   python loadgen.py --server asgi --window 2 --concurrency 32
+#
+# Open loop latencies are measured from when a request was due to be sent, not
+# from when a free client got to it, so a server that falls behind shows up
+# in the tail instead of silently slowing the offered load. Raw samples go to
+# --save as JSON and --hgrm writes HdrHistogram style percentile distributions
+# per operation, which the HdrHistogram plotter reads, to compare builds.
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import queue
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+OPS = ('register', 'login', 'login_invalid')
+EXPECTED = {'register': True, 'login': True, 'login_invalid': False}
+
+# Outcomes of one request
+OK = 'ok'         # the answer the server should give
+WRONG = 'wrong'   # a response, but the wrong answer
+ERROR = 'error'   # no response, a timeout or a status other than 200
+DROPPED = 'dropped' # open loop: not started before the drain deadline
+
+
+def startServer(keys, host, port, log=None, server='flask', window=None):
+    ''' Start pythonServer.py under the Flask development server, or
+    asgiServer.py with a coalescing window of `window` ms '''
+    env = dict(os.environ)
+    if keys:
+        env['PASTA_KEYS'] = os.path.abspath(keys)
+    if server == 'asgi':
+        cmd = [sys.executable, 'asgiServer.py', '--host', host, '--port', str(port)]
+        if window is not None:
+            cmd += ['--window', str(window)]
+    else:
+        cmd = [sys.executable, '-m', 'flask', '--app', 'pythonServer', 'run',
+               '--host', host, '--port', str(port)]
+    out = open(log, 'ab') if log else subprocess.DEVNULL
+    return subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                            stdout=out, stderr=subprocess.STDOUT)
+
+
+def waitReady(url, timeout, proc=None):
+    ''' Poll /metrics until the server answers '''
+    deadline = time.monotonic() + timeout
+    parts = urlsplit(url)
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError('server exited with status {}'.format(proc.returncode))
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=1)
+            conn.request('GET', '/metrics')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server at {} not ready after {}s'.format(url, timeout))
+
+
+class Client:
+    ''' One connection to the server, used by one thread at a time '''
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+
+    def call(self, op, username, password):
+        ''' Outcome of one request '''
+        path = '/register' if op == 'register' else '/login'
+        query = urlencode({'username': username, 'password': password})
+        try:
+            self.conn.request('GET', path + '?' + query)
+            res = self.conn.getresponse()
+            body = res.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            return ERROR
+        if res.status != 200:
+            return ERROR
+        try:
+            answer = json.loads(body)
+        except ValueError:
+            return WRONG
+        return OK if answer is EXPECTED[op] else WRONG
+
+    def close(self):
+        self.conn.close()
+
+
+class Workload:
+    ''' Picks operations and credentials
+    ``Args:``
+        tag: (str) prefix of the usernames of this run
+        users: (int) number of registered users that logins pick from
+        register: (float) fraction of operations that register a new user
+        invalid: (float) fraction of logins with a wrong password
+    '''
+    def __init__(self, tag, users, register, invalid):
+        self.tag = tag
+        self.users = users
+        self.register = register
+        self.invalid = invalid
+        self.lock = threading.Lock()
+        self.fresh = users
+
+    def credentials(self, j):
+        return '{}-{}'.format(self.tag, j), 'pw-{}-{}'.format(self.tag, j)
+
+    def next(self, rng):
+        ''' (op, username, password) '''
+        if rng.random() < self.register:
+            with self.lock:
+                j = self.fresh
+                self.fresh += 1
+            return ('register',) + self.credentials(j)
+        username, password = self.credentials(rng.randrange(self.users))
+        if rng.random() < self.invalid:
+            return 'login_invalid', username, password + '-wrong'
+        return 'login', username, password
+
+
+def preregister(url, workload, concurrency, timeout):
+    ''' Register the users logins pick from, returns the number of failures '''
+    todo = queue.Queue()
+    for j in range(workload.users):
+        todo.put(j)
+    lock = threading.Lock()
+    failed = [0]
+
+    def worker():
+        client = Client(url, timeout)
+        while True:
+            try:
+                j = todo.get_nowait()
+            except queue.Empty:
+                break
+            if client.call('register', *workload.credentials(j)) != OK:
+                with lock:
+                    failed[0] += 1
+        client.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return failed[0]
+
+
+def closedLoop(url, workload, concurrency, duration, timeout, seed):
+    ''' concurrency clients sending requests back to back for duration seconds
+    ``Returns``
+        (list) of (op, start s, latency s, outcome) samples
+    '''
+    start = time.perf_counter()
+    stop = start + duration
+    results = [[] for _ in range(concurrency)]
+
+    def worker(w):
+        rng = random.Random('{}/{}'.format(seed, w))
+        client = Client(url, timeout)
+        out = results[w]
+        while True:
+            op, username, password = workload.next(rng)
+            t0 = time.perf_counter()
+            if t0 >= stop:
+                break
+            outcome = client.call(op, username, password)
+            out.append((op, t0 - start, time.perf_counter() - t0, outcome))
+        client.close()
+
+    threads = [threading.Thread(target=worker, args=(w,)) for w in range(concurrency)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return [s for out in results for s in out]
+
+
+def arrivals(rate, duration, rng, poisson=True):
+    ''' Send times in seconds from the start, exponential or even gaps '''
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate) if poisson else 1.0 / rate
+        if t >= duration:
+            return
+        yield t
+
+
+def openLoop(url, workload, concurrency, rate, duration, timeout, seed, poisson=True, drain=10.0):
+    ''' Requests arriving at rate per second for duration seconds, served by
+    up to concurrency clients. Latency counts from the due time. Requests
+    not started drain seconds after the end are dropped.
+    ``Returns``
+        (list) of (op, due s, latency s, outcome) samples
+    '''
+    rng = random.Random(seed)
+    due = queue.Queue()
+    for t in arrivals(rate, duration, rng, poisson):
+        due.put((t,) + workload.next(rng))
+    start = time.perf_counter()
+    cutoff = duration + drain
+    results = [[] for _ in range(concurrency)]
+
+    def worker(w):
+        client = Client(url, timeout)
+        out = results[w]
+        while True:
+            try:
+                t, op, username, password = due.get_nowait()
+            except queue.Empty:
+                break
+            wait = start + t - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            if time.perf_counter() - start > cutoff:
+                out.append((op, t, 0.0, DROPPED))
+                continue
+            outcome = client.call(op, username, password)
+            out.append((op, t, time.perf_counter() - start - t, outcome))
+        client.close()
+
+    threads = [threading.Thread(target=worker, args=(w,)) for w in range(concurrency)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return [s for out in results for s in out]
+
+
+def percentile(ordered, p):
+    ''' Nearest rank percentile, p in [0, 100], of a sorted list '''
+    if not ordered:
+        return float('nan')
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+PERCENTILES = (50, 95, 99, 99.9)
+
+
+def summarize(samples, elapsed):
+    ''' Per operation (and 'all') counts, rates and latency percentiles in ms '''
+    summary = {}
+    for op in OPS + ('all',):
+        mine = [s for s in samples if op == 'all' or s[0] == op]
+        if not mine:
+            continue
+        outcomes = {o: 0 for o in (OK, WRONG, ERROR, DROPPED)}
+        for s in mine:
+            outcomes[s[3]] += 1
+        done = sorted(s[2] * 1e3 for s in mine if s[3] != DROPPED)
+        row = {'count': len(mine), 'throughput': len(done) / elapsed}
+        for o, n in outcomes.items():
+            row[o] = n
+            row[o + '_rate'] = n / len(mine)
+        for p in PERCENTILES:
+            row['p{:g}'.format(p)] = percentile(done, p)
+        row['max'] = done[-1] if done else float('nan')
+        summary[op] = row
+    return summary
+
+
+def printSummary(summary, elapsed):
+    print('{:<14} {:>7} {:>8} {:>7} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'op', 'count', 'req/s', 'wrong', 'error', 'dropped',
+        'p50 ms', 'p95 ms', 'p99 ms', 'p99.9 ms', 'max ms'))
+    for op, row in summary.items():
+        print('{:<14} {:>7} {:>8.1f} {:>7.2%} {:>7.2%} {:>7.2%} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            op, row['count'], row['throughput'], row['wrong_rate'], row['error_rate'],
+            row['dropped_rate'], row['p50'], row['p95'], row['p99'], row['p99.9'], row['max']))
+    print('{:.1f}s elapsed'.format(elapsed))
+
+
+def hgrm(latencies, ticks=5):
+    ''' Percentile distribution of latencies (ms) in the text format of
+    HdrHistogram's outputPercentileDistribution, from exact values '''
+    ordered = sorted(latencies)
+    n = len(ordered)
+    lines = ['{:>12} {:>14} {:>10} {:>14}'.format('Value', 'Percentile', 'TotalCount', '1/(1-Percentile)'), '']
+    level = 0.0
+    while n:
+        rank = max(1, math.ceil(level / 100 * n))
+        if rank >= n:
+            break
+        lines.append('{:12.3f} {:14.12f} {:10d} {:14.2f}'.format(
+            ordered[rank - 1], level / 100, rank, 1 / (1 - level / 100)))
+        # As HdrHistogram: `ticks` steps per halving of the distance to 100%
+        halvings = int(math.log2(100 / (100 - level))) + 1
+        level += 100 / (ticks * 2 ** halvings)
+    if n:
+        lines.append('{:12.3f} {:14.12f} {:10d}'.format(ordered[-1], 1.0, n))
+        sd = statistics.pstdev(ordered)
+        lines.append('#[Mean    = {:12.3f}, StdDeviation   = {:12.3f}]'.format(statistics.fmean(ordered), sd))
+        lines.append('#[Max     = {:12.3f}, Total count    = {:12d}]'.format(ordered[-1], n))
+    return '\n'.join(lines) + '\n'
+
+
+def compare(baseline, summary):
+    ''' Print percentiles and error rates against a saved run '''
+    print('{:<14} {:<8} {:>10} {:>10} {:>8}'.format('op', 'stat', 'base', 'new', 'change'))
+    for op, row in summary.items():
+        old = baseline.get(op)
+        if old is None:
+            continue
+        for stat in ('throughput', 'p50', 'p95', 'p99', 'p99.9'):
+            change = row[stat] / old[stat] - 1 if old[stat] else 0.0
+            print('{:<14} {:<8} {:>10.1f} {:>10.1f} {:>+7.1%}'.format(op, stat, old[stat], row[stat], change))
+        for stat in ('wrong_rate', 'error_rate'):
+            print('{:<14} {:<8} {:>10.2%} {:>10.2%}'.format(op, stat.split('_')[0], old[stat], row[stat]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for pythonServer.py')
+    parser.add_argument('--url', help='server to load (default: start one on this machine)')
+    parser.add_argument('--keys', help='key file for the started server (PASTA_KEYS)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask',
+                        help='start pythonServer.py (flask) or asgiServer.py (asgi)')
+    parser.add_argument('--window', type=float, default=None,
+                        help='coalescing window in ms for --server asgi')
+    parser.add_argument('--server-log', help='append the started server\'s output to this file')
+    parser.add_argument('--users', type=int, default=50, help='users registered before the run')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='clients (open loop: most requests in flight)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='open loop arrivals per second (default: closed loop)')
+    parser.add_argument('--uniform', action='store_true',
+                        help='open loop: evenly spaced instead of Poisson arrivals')
+    parser.add_argument('--drain', type=float, default=10.0,
+                        help='open loop: seconds after the end before unstarted requests are dropped')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of load')
+    parser.add_argument('--register', type=float, default=0.1,
+                        help='fraction of requests that register a new user')
+    parser.add_argument('--invalid', type=float, default=0.1,
+                        help='fraction of logins with a wrong password')
+    parser.add_argument('--timeout', type=float, default=30.0, help='request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=5471, help='seed for the operation mix')
+    parser.add_argument('--save', help='write the summary and raw samples to this JSON file')
+    parser.add_argument('--hgrm', help='write <prefix>.<op>.hgrm percentile distributions')
+    parser.add_argument('--compare', help='JSON file from --save to compare against')
+    args = parser.parse_args()
+
+    proc = None
+    url = args.url
+    if url is None:
+        url = 'http://{}:{}'.format(args.host, args.port)
+        proc = startServer(args.keys, args.host, args.port, args.server_log,
+                           args.server, args.window)
+    try:
+        # A key ceremony on first start can take a while
+        waitReady(url, 600 if proc else 10, proc)
+        tag = 'load-{}-{:x}'.format(os.getpid(), random.getrandbits(32))
+        workload = Workload(tag, args.users, args.register, args.invalid)
+        start = time.perf_counter()
+        failed = preregister(url, workload, args.concurrency, args.timeout)
+        sys.stderr.write('Registered {} users in {:.1f}s, {} failed\n'.format(
+            args.users, time.perf_counter() - start, failed))
+
+        start = time.perf_counter()
+        if args.rate:
+            samples = openLoop(url, workload, args.concurrency, args.rate, args.duration,
+                               args.timeout, args.seed, not args.uniform, args.drain)
+        else:
+            samples = closedLoop(url, workload, args.concurrency, args.duration,
+                                 args.timeout, args.seed)
+        elapsed = time.perf_counter() - start
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    summary = summarize(samples, elapsed)
+    printSummary(summary, elapsed)
+
+    if args.hgrm:
+        for op in OPS + ('all',):
+            done = [s[2] * 1e3 for s in samples if (op == 'all' or s[0] == op) and s[3] != DROPPED]
+            if done:
+                with open('{}.{}.hgrm'.format(args.hgrm, op), 'w') as f:
+                    f.write(hgrm(done))
+
+    if args.save:
+        data = {
+            'meta': {
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'platform': platform.platform(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'url': url,
+                'server': args.server if proc else None,
+                'window': args.window if proc else None,
+                'mode': 'open' if args.rate else 'closed',
+                'rate': args.rate,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'users': args.users,
+                'register': args.register,
+                'invalid': args.invalid,
+                'seed': args.seed,
+                'elapsed': elapsed,
+            },
+            'summary': summary,
+            # op: [[start s, latency ms, outcome], ...] in start order
+            'samples': {op: [[round(s[1], 6), round(s[2] * 1e3, 3), s[3]]
+                             for s in sorted(samples, key=lambda s: s[1]) if s[0] == op]
+                        for op in OPS},
+        }
+        with open(args.save, 'w') as f:
+            json.dump(data, f)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)['summary'], summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Operation counters and per-phase latency histograms, off by default.
+# Instrumented code guards every update with
+#
+#   if metrics.ENABLED:
+#       metrics.count('ec_add')
+#
+# so with metrics off the hot paths pay a single branch. Counts are per
+# process: work done in process pool workers (see pasta.startExecutor) is not
+# seen by the process that serves /metrics.
+import functools
+import threading
+import time
+
+ENABLED = False
+
+# Latency bucket upper bounds in seconds, as in Prometheus client libraries
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+OPS = {
+    'field_inv': 'Field inversions (extended Euclid)',
+    'ec_add': 'Elliptic curve point additions',
+    'ec_double': 'Elliptic curve point doublings',
+    'modexp': 'Modular exponentiations mod N',
+    'multiexp': 'Simultaneous multi-exponentiations mod N',
+    'aes_encrypt': 'AES-EAX encryptions',
+    'aes_decrypt': 'AES-EAX decryptions',
+}
+
+lock = threading.Lock()
+counts = dict.fromkeys(OPS, 0)
+histograms = {} # phase: [bucket counts..., +Inf count, sum of seconds]
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    with lock:
+        for op in counts:
+            counts[op] = 0
+        histograms.clear()
+
+
+def count(op, n=1):
+    ''' Add n to the counter of op, a key of OPS '''
+    with lock:
+        counts[op] += n
+
+
+def observe(phase, seconds):
+    ''' Record one latency sample of phase '''
+    with lock:
+        h = histograms.get(phase)
+        if h is None:
+            h = histograms[phase] = [0] * (len(BUCKETS) + 2)
+        for j, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                h[j] += 1
+                break
+        else:
+            h[len(BUCKETS)] += 1
+        h[-1] += seconds
+
+
+def timed(phase):
+    ''' Decorator recording the latency of every call in the histogram of phase '''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(phase, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def render():
+    ''' Counters and histograms in the Prometheus text exposition format '''
+    with lock:
+        ops = dict(counts)
+        hists = {phase: list(h) for phase, h in histograms.items()}
+
+    lines = ['# HELP pasta_ops_total Primitive operations, by operation',
+             '# TYPE pasta_ops_total counter']
+    for op, value in ops.items():
+        lines.append('pasta_ops_total{{op="{}"}} {}'.format(op, value))
+
+    lines += ['# HELP pasta_phase_seconds Latency of protocol phases',
+              '# TYPE pasta_phase_seconds histogram']
+    for phase in sorted(hists):
+        h = hists[phase]
+        total = 0
+        for bound, n in zip(BUCKETS, h):
+            total += n
+            lines.append('pasta_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(phase, bound, total))
+        total += h[len(BUCKETS)]
+        lines.append('pasta_phase_seconds_bucket{{phase="{}",le="+Inf"}} {}'.format(phase, total))
+        lines.append('pasta_phase_seconds_sum{{phase="{}"}} {}'.format(phase, h[-1]))
+        lines.append('pasta_phase_seconds_count{{phase="{}"}} {}'.format(phase, total))
+    return '\n'.join(lines) + '\n'
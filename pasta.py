@@ -11,7 +11,13 @@ from Crypto.Util.number import inverse
 
 # Standard modules
 import collections
+import json
+import os
+import sys
+import threading
+import time
 from binascii import hexlify
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Modules from filepaths 
 # Should be arranged like so:
@@ -24,6 +30,9 @@ from binascii import hexlify
 #     └── znUtil.py
 import top.TOP as top  
 import ttg.shoup as shoup
+import metrics
+import records
+import wire
 
 ##########################################################################################
 #
@@ -31,8 +40,11 @@ import ttg.shoup as shoup
 #
 ##########################################################################################
 
-serverDict = {} # to hold client records
+serverDict = {} # to hold client records, i: `records` store (see openStores)
 serverKeyDict = {} # to hold server 'keys' for s value
+serverKeyNafDict = {} # to hold wNAF recodings of the server 'keys', built once in globalSetup
+
+KEYFILE_VERSION = 3 # bump whenever the saveKeys() format changes
 
 PubParam = collections.namedtuple('PubParam', 'k n t tpp opp nonce')
 SecParam = collections.namedtuple('SecParam', 'pwd rho')
@@ -40,6 +52,20 @@ SecParam = collections.namedtuple('SecParam', 'pwd rho')
 class CryptoError(Exception): # Simple exception class for exiting
     pass
 
+class BadServerError(CryptoError):
+    ''' Raised by finalize() when some responses are malformed, fail to
+    decrypt or fail their proofs
+    ``Attributes``
+        bad: (list) indices of the servers whose responses were invalid
+        good: (dict) i: yi partial tokens from the other servers (verified
+            if a vk was given), can be passed back to finalize() as
+            `verified` on a retry
+    '''
+    def __init__(self, bad, good):
+        CryptoError.__init__(self, bad)
+        self.bad = bad
+        self.good = good
+
 
 ##########################################################################################
 #
@@ -68,18 +94,19 @@ def initialize(username, password, k, n, t):
     secrets = SecParam(pwd=password, rho=randrange(1, pp.opp.n))
     return C, secrets, shares, vk, pp
 
-def globalSetup(k, n, t):
+def globalSetup(k, n, t, G=None):
     ''' Runs global setup, `called by initialize()`
     ``Args``
         k: (int) security parameter
         n: (int) Number of servers
         t: (int) threshold
+        G: (`shoup.Zn`) `optional` prebuilt RSA parameters, see shoup.setup()
     ``Returns``
         shares  : (list) of (i, share[i]) tuples
         vk : (tuple) (N, e) for RSA algoritm tuple
         pp : (`PubParam`) tuple
     '''
-    shares, vk, tpp = shoup.setup(k, n, t)
+    shares, vk, tpp = shoup.setup(k, n, t, G)
     curve = top.setup()
 
     pp = PubParam( k=k, n=n, t=t, tpp=tpp, opp = curve, nonce=get_random_bytes(16))
@@ -87,8 +114,130 @@ def globalSetup(k, n, t):
 
     # Set up server storage
     for i in range(1, n+1):
-        serverDict[i] = {}
+        serverDict[i] = records.MemoryStore()
         serverKeyDict[i] = randrange(1, curve.n) # setting up ki
+        serverKeyNafDict[i] = top.wnaf(serverKeyDict[i], top.WINDOW) # ki is fixed, so recode it once
+
+    return shares, vk, pp
+
+##########################################################################################
+#
+# Key Ceremony
+#
+##########################################################################################
+
+def keyCeremony(path, k, n, t, G=None):
+    ''' Run globalSetup once and save the result, see saveKeys(). Besides the
+    full file at path, server i's own file is written to serverKeyPath(path, i)
+    ``Args``
+        path: (str) file to write the keys to
+        k: (int) security parameter
+        n: (int) Number of servers
+        t: (int) threshold
+        G: (`shoup.Zn`) `optional` prebuilt RSA parameters, e.g. with fresh primes
+    ``Returns``
+        shares, vk, pp : as returned by globalSetup()
+    '''
+    shares, vk, pp = globalSetup(k, n, t, G)
+    saveKeys(path, shares, vk, pp)
+    for i in range(1, n+1):
+        saveKeys(serverKeyPath(path, i), shares, vk, pp, [i])
+    return shares, vk, pp
+
+def serverKeyPath(path, i):
+    ''' Path of server i's key file next to the full key file path,
+    e.g. pasta_keys.json -> pasta_keys.server3.json '''
+    root, ext = os.path.splitext(path)
+    return '{}.server{}{}'.format(root, i, ext or '.json')
+
+def saveKeys(path, shares, vk, pp, servers=None):
+    ''' Save the RSA shares, verification key, public parameters and server
+    'keys' ki to a versioned JSON file. Integers are stored as hex strings.
+    The file holds the shares and ki of the servers given, so it is created
+    readable by the owner only. The factorization of N and d are never saved
+    (see `Zn.SECRETS`).
+    ``Args``
+        path: (str) file to write
+        shares  : (list) of (i, share[i]) tuples
+        vk : (`shoup.VerKey`) verification key
+        pp : (`PubParam`) tuple
+        servers: (list) `optional` indices of the servers whose share and ki
+            go in the file, default all of them
+    ``Returns``
+        None
+    '''
+    if servers is None:
+        servers = range(1, pp.n+1)
+    servers = set(servers)
+    delta, G = pp.tpp
+    params = G.toDict()
+    data = {
+        'version': KEYFILE_VERSION,
+        'k': pp.k, 'n': pp.n, 't': pp.t,
+        'curve': pp.opp.name,
+        'nonce': pp.nonce.hex(),
+        'delta': hex(delta),
+        'zn': {name: hex(value) for name, value in params.items()},
+        'shares': [[i, hex(s)] for (i, s) in shares if i in servers],
+        'vk': {'N': hex(vk.N), 'e': hex(vk.e), 'v': hex(vk.v),
+               'vki': [hex(v) for v in vk.vki]},
+        'server_keys': {str(i): hex(serverKeyDict[i]) for i in sorted(servers)},
+    }
+
+    # Write to a temporary file first so a crash never leaves a partial key file
+    tmp = path + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def loadKeys(path, i=None):
+    ''' Load keys written by saveKeys() and install the server 'keys' ki.
+    Existing client records in serverDict are kept.
+    ``Args``
+        path: (str) file written by saveKeys()
+        i: (int) `optional` install only server i's ki and return only its
+            share, e.g. for a protocol server loading its own file
+    ``Returns``
+        shares  : (list) of (i, share[i]) tuples held in the file
+        vk : (`shoup.VerKey`) verification key
+        pp : (`PubParam`) tuple
+    '''
+    with open(path) as f:
+        data = json.load(f)
+
+    if data.get('version') not in (1, 2, KEYFILE_VERSION):
+        raise CryptoError('unsupported key file version {}'.format(data.get('version')))
+
+    curve = top.setup()
+    if data['curve'] != curve.name:
+        raise CryptoError('key file is for curve {}'.format(data['curve']))
+
+    # version 1 also stored eprime/bezout, these are now computed per signer
+    # subset. Older files also hold the dealer secrets, these are not loaded
+    params = {name: int(value, 16) for name, value in data['zn'].items()
+              if name in shoup.Zn.FIELDS}
+    G = shoup.Zn.fromDict(params)
+    tpp = (int(data['delta'], 16), G)
+
+    shares = [(j, int(s, 16)) for (j, s) in data['shares']]
+    vk = shoup.VerKey(N=int(data['vk']['N'], 16), e=int(data['vk']['e'], 16),
+                      v=int(data['vk']['v'], 16),
+                      vki=tuple(int(v, 16) for v in data['vk']['vki']))
+    pp = PubParam(k=data['k'], n=data['n'], t=data['t'], tpp=tpp, opp=curve,
+                  nonce=bytes.fromhex(data['nonce']))
+
+    keys = {int(j): int(ki, 16) for j, ki in data['server_keys'].items()}
+    if i is not None:
+        if i not in keys or i not in dict(shares):
+            raise CryptoError('key file has no keys for server {}'.format(i))
+        keys = {i: keys[i]}
+        shares = [(j, s) for (j, s) in shares if j == i]
+
+    for j, kj in keys.items():
+        serverDict.setdefault(j, records.MemoryStore())
+        serverKeyDict[j] = kj
+        serverKeyNafDict[j] = top.wnaf(kj, top.WINDOW)
 
     return shares, vk, pp
 
@@ -98,39 +247,84 @@ def globalSetup(k, n, t):
 #
 ##########################################################################################
 
-def signUp(C, sec, pp):
+def getPwdPoint(pwd, h2c='sqrt'):
+    ''' Hash a password onto the curve
+    ``Args:``
+        pwd: (str) Plaintext password
+        h2c: (str) hash-to-curve method, a key of `top.HASH_TO_CURVE`
+            'cipolla' - original getPoint search with Cipolla-Lehmer roots
+            'sqrt'    - same search with a single pow per square root
+            'sswu'    - simplified SWU map, no search
+    ``Returns``
+        pwd_point : (`top.Point`) password point
+    '''
+    if h2c not in top.HASH_TO_CURVE:
+        raise CryptoError
+
+    pwd_bytes = bytes(pwd, 'utf-8')
+    s = SHA256.new(pwd_bytes)
+    pwd_hash = int(s.hexdigest(), 16)
+    return top.HASH_TO_CURVE[h2c](pwd_hash)
+
+
+def deriveKey(h, i):
+    ''' Derive server i's record / SKE key from the point h = ki * pwd_point
+    ``Args:``
+        h: (`top.Point`) point
+        i: (int) server index
+    ``Returns``
+        (bytes) SHA256(compressed h || i as 4 bytes)
+    '''
+    s = SHA256.new()
+    s.update(top.point_to_bytes(h))
+    s.update(i.to_bytes(4, 'big'))
+    return s.digest()
+
+
+def signUp(C, sec, pp, h2c='sqrt'):
     ''' Generate Client Record
     ``Args:``
         C: (int) Client ID
         sec: (`SecParam`) client security parameter tuple
         pp: (`PubParam`) global public parameters
+        h2c: (str) hash-to-curve method, must match the one used in request()
     ``Returns``
         msg_dict: dict
             i : (h_i)
             dict of index to sign up tuple
     '''
 
-    pwd_bytes = bytes(sec.pwd, 'utf-8')
-    s = SHA256.new(pwd_bytes)
-    pwd_hash = int(s.hexdigest(), 16)
-    pwd_point = top.getPoint(pwd_hash)
+    pwd_point = getPwdPoint(sec.pwd, h2c)
 
 
     msg_dict = {}
     for i in range(1, pp.n+1):
-        h = top.scalar_mult(serverKeyDict[i], pwd_point)
-        x = bytes(str(h[0]), 'utf-8')
-        y = bytes(str(h[1]), 'utf-8')
-
-        s = SHA256.new()
-        s.update(x)
-        s.update(y)
-        s.update(bytes(i))
-        msg_dict[i] = s.digest()
+        h = top.scalar_mult_wnaf(serverKeyDict[i], pwd_point, top.WINDOW, serverKeyNafDict[i])
+        msg_dict[i] = deriveKey(h, i)
 
     return msg_dict
 
 
+def signUpBatch(users, pp, h2c='sqrt'):
+    ''' signUp() for many clients at once
+    Each server's ki multiplies all the password points in one
+    `top.scalar_mult_batch` call, so the batch shares its inversions.
+    ``Args:``
+        users: (list) of (C, pwd) tuples, pwd the plaintext password
+        pp: (`PubParam`) global public parameters
+        h2c: (str) hash-to-curve method, must match the one used in request()
+    ``Returns``
+        (list) of (C, msg_dict) tuples in the order of users, for storeMany()
+    '''
+    points = [getPwdPoint(pwd, h2c) for _, pwd in users]
+    msgs = [{} for _ in users]
+    for i in range(1, pp.n+1):
+        hs = top.scalar_mult_batch(serverKeyDict[i], points, top.WINDOW, serverKeyNafDict[i])
+        for msg, h in zip(msgs, hs):
+            msg[i] = deriveKey(h, i)
+    return [(C, msg) for (C, _), msg in zip(users, msgs)]
+
+
 def store(C, msg_list,  pp):
     ''' Store a single client record in ServerDict
     ``Args:``
@@ -138,13 +332,200 @@ def store(C, msg_list,  pp):
         msg: (list) list of tuples (m, h_i) generated by signUp()
         pp: (`PubParam`) global public parameters
     ``Returns``
-        None
+        (bool) True if C was new. False if some server already knew C, then
+        nothing is stored and the old password stays in place
     '''
-    for i in range(1, pp.n+1):
-        if C in serverDict[i].keys():
-            # Do nothing, client already added
-            return
-        serverDict[i][C] = msg_list[i]
+    if registered(C, pp):
+        return False
+    # A concurrent store() of the same C can still win on some servers
+    return all([serverDict[i].add(C, msg_list[i]) for i in range(1, pp.n+1)])
+
+
+def registered(C, pp):
+    ''' True if any server holds a record for client C '''
+    return any(C in serverDict[i] for i in range(1, pp.n+1))
+
+
+def storeMany(batch, pp):
+    ''' store() for many clients, one write per server
+    ``Args:``
+        batch: (list) of (C, msg_list) tuples
+        pp: (`PubParam`) global public parameters
+    ``Returns``
+        (dict) i: number of new records on server i
+    '''
+    return {i: serverDict[i].addMany([(C, msg_list[i]) for C, msg_list in batch])
+            for i in range(1, pp.n+1)}
+
+
+def storeEach(batch, pp):
+    ''' storeMany() that reports on every client
+    ``Args:``
+        batch: (list) of (C, msg_list) tuples
+        pp: (`PubParam`) global public parameters
+    ``Returns``
+        (list) of bools, True where every server stored C's new record,
+        False where C was already registered
+    '''
+    new = [serverDict[i].addEach([(C, msg_list[i]) for C, msg_list in batch])
+           for i in range(1, pp.n+1)]
+    return [all(flags) for flags in zip(*new)] if batch else []
+
+
+def openStores(directory, servers, **kwargs):
+    ''' Keep the records of the given servers in SQLite files in directory.
+    Call after globalSetup() or loadKeys(), which start with in-memory stores
+    ``Args:``
+        directory: (str) created if missing, holds server<i>.db per server
+        servers: (list) server indices
+        kwargs: passed to `records.SQLiteStore`
+    '''
+    os.makedirs(directory, exist_ok=True)
+    for i in servers:
+        serverDict[i] = records.SQLiteStore(
+            os.path.join(directory, 'server{}.db'.format(i)), **kwargs)
+
+
+def closeStores():
+    ''' Flush and close every server's record store '''
+    for recs in serverDict.values():
+        recs.close()
+
+
+def storeRecord(i, C, hi):
+    ''' Store one client record with server i only, as a server process does
+    ``Args:``
+        i: (int) server index
+        C: (int) Client ID
+        hi: (bytes) server i's record from signUp()
+    ``Returns``
+        (bool) False if C was already registered, the record is kept as is
+    '''
+    return serverDict[i].add(C, hi)
+
+##########################################################################################
+#
+# Parallel Execution
+#
+##########################################################################################
+
+# Per-server work in respond(), respond_batch(), requestTk() and finalize() is
+# independent big-integer and curve arithmetic. When an executor is running it
+# is spread over its workers instead of running one server after another under
+# the GIL.
+EXECUTOR = None
+EXECUTOR_WORKERS = 1
+workerState = None # (vk, pp) in each worker, set once by initWorker()
+
+
+def gilEnabled():
+    ''' False on a free-threaded CPython build running without the GIL '''
+    return getattr(sys, '_is_gil_enabled', lambda: True)()
+
+
+def initWorker(vk, pp, keys):
+    ''' Runs once in each worker, so vk, pp and the server 'keys' ki are not
+    pickled with every task '''
+    global workerState
+    workerState = (vk, pp)
+    for i, ki in keys.items():
+        if serverKeyDict.get(i) != ki:
+            serverKeyDict[i] = ki
+            serverKeyNafDict[i] = top.wnaf(ki, top.WINDOW)
+
+
+def startExecutor(vk, pp, workers=None, kind=None):
+    ''' Start running per-server work in parallel
+    respond(), respond_batch(), requestTk() and finalize() use the executor
+    until stopExecutor() is called. Workers keep their own copy of vk, pp and the
+    ki, so they must be the ones passed to those functions, and the executor
+    has to be restarted after re-keying.
+    ``Args:``
+        vk: (`shoup.VerKey`) verification key
+        pp: (`PubParam`) global public parameters
+        workers: (int) `optional` number of workers, default all cores
+        kind: (str) `optional` 'process' or 'thread'. Default is a process
+            pool, or a thread pool on a free-threaded build without the GIL
+    ``Returns``
+        the executor
+    '''
+    global EXECUTOR, EXECUTOR_WORKERS
+    stopExecutor()
+    workers = workers or os.cpu_count() or 1
+    kind = kind or ('process' if gilEnabled() else 'thread')
+    if kind == 'process':
+        EXECUTOR = ProcessPoolExecutor(workers, initializer=initWorker,
+                                       initargs=(vk, pp, dict(serverKeyDict)))
+    elif kind == 'thread':
+        initWorker(vk, pp, serverKeyDict)
+        EXECUTOR = ThreadPoolExecutor(workers)
+    else:
+        raise ValueError('unknown executor kind {}'.format(kind))
+    EXECUTOR_WORKERS = workers
+    return EXECUTOR
+
+
+def stopExecutor():
+    ''' Go back to running everything in the calling thread '''
+    global EXECUTOR, EXECUTOR_WORKERS
+    if EXECUTOR is not None:
+        EXECUTOR.shutdown()
+    EXECUTOR, EXECUTOR_WORKERS = None, 1
+
+
+def respondTask(i, ski, hi, C, x, request, prove):
+    vk, pp = workerState
+    return evalPart(i, ski, hi, C, x, request, vk, pp, prove)
+
+
+def respondBatchTask(i, ski, items, prove):
+    vk, pp = workerState
+    return evalPartBatch(i, ski, items, vk, pp, prove)
+
+
+def signUpTask(users, h2c):
+    vk, pp = workerState
+    return signUpBatch(users, pp, h2c)
+
+
+def verifyTask(parts, proofs, concat):
+    vk, pp = workerState
+    return shoup.verifyParts(parts, proofs, vk, concat, pp.tpp)
+
+
+def respondAll(T, shares, C, x, req_dict, vk, pp, prove):
+    ''' respond() for every server in T, all at once when an executor is running
+    ``Returns``
+        (dict) i: resi
+    '''
+    if EXECUTOR is None:
+        return {i: respond(i, shares[i-1], C, x, req_dict[i], vk, pp, prove) for i in T}
+
+    futures = {}
+    for i in T:
+        try:
+            C, request = wire.decodeRequest(req_dict[i])
+        except ValueError:
+            raise CryptoError
+        hi = serverDict[i].get(C)
+        if hi is None:
+            raise CryptoError
+        futures[i] = EXECUTOR.submit(respondTask, i, shares[i-1], hi, C, x, request, prove)
+    return {i: fut.result() for i, fut in futures.items()}
+
+
+def checkParts(parts, proofs, vk, concat, pp):
+    ''' shoup.verifyParts(), split into one batch per worker when an
+    executor is running
+    ``Returns``
+        (list) indices i whose partial token is wrong
+    '''
+    k = min(EXECUTOR_WORKERS, len(parts))
+    if EXECUTOR is None or k < 2:
+        return shoup.verifyParts(parts, proofs, vk, concat, pp.tpp)
+    futures = [EXECUTOR.submit(verifyTask, parts[j::k], proofs[j::k], concat)
+               for j in range(k)]
+    return [i for fut in futures for i in fut.result()]
 
 ##########################################################################################
 #
@@ -152,119 +533,270 @@ def store(C, msg_list,  pp):
 #
 ##########################################################################################
 
-def request(C, sec,  T, pp):
+class LoginContext:
+    ''' Client side state for one login
+    The password point, the blinded request rho * pwd_point and the recoded
+    rho^-1 are computed once and shared by every server in T, and by any
+    retry against another server subset.
+    ``Args:``
+        C: (int) Client ID
+        sec: (`SecParam`) client security parameter
+        pp: (`PubParam`) global public parameters
+        h2c: (str) hash-to-curve method, must match the one used in signUp()
+    '''
+    # The client's work for a request, hashing to the curve and blinding,
+    # is done here, so this is what the 'request' phase times
+    @metrics.timed('request')
+    def __init__(self, C, sec, pp, h2c='sqrt'):
+        self.C = C
+        self.sec = sec
+        self.pp = pp
+
+        # Compute Password hash on curve, then blind it
+        self.pwd_point = getPwdPoint(sec.pwd, h2c)
+        self.blinded = top.scalar_mult(sec.rho, self.pwd_point)
+
+        # rho^-1 is the same for every response, so recode it once
+        self.rho_inv = inverse(sec.rho, pp.opp.n)
+        self.rho_inv_naf = top.wnaf(self.rho_inv, top.WINDOW)
+
+    def request(self, T, verified=None):
+        ''' Build the requests for the servers in T
+        ``Args:``
+            T: (list) list in [1..n+1], which servers are you requesting?
+            verified: (dict) `optional` partial tokens kept from an earlier
+                attempt, these count towards the threshold
+        ``Returns``
+            requests: (dict) - dict of `wire` request frames:
+                i:  reqi
+            st: () secret state
+        '''
+        if len(set(T)) + len(verified or {}) < self.pp.t:
+            raise CryptoError
+
+        # Every server gets the same request, so encode it once
+        reqi = wire.encodeRequest(self.C, self.blinded)
+        req_dict = {}
+        for i in T:
+            req_dict[i] = reqi
+
+        return req_dict, (self, T)
+
+    def unblind(self, z):
+        ''' Compute rho^-1 * z for a (validated) response point z '''
+        return top.scalar_mult_wnaf(self.rho_inv, z, top.WINDOW, self.rho_inv_naf)
+
+    def unblind_batch(self, zlist):
+        ''' Compute rho^-1 * z for a list of (validated) response points,
+        sharing the double/add schedule and the affine normalization '''
+        return top.scalar_mult_batch(self.rho_inv, zlist, top.WINDOW, self.rho_inv_naf)
+
+
+def request(C, sec,  T, pp, h2c='sqrt'):
     ''' Initiate a request for a token
     ``Args:``
         C: (int) Client ID
         sec: (`SecParam`) client security parameter
         T: (list) list in [1..n+1], which servers are you requesting?
         pp: (`PubParam`) global public parameters
+        h2c: (str) hash-to-curve method, must match the one used in signUp()
     ``Returns``
         st: () secret state
-        requests: (dict) - dict of request tuples:
-            i:  (C, reqi)
+        requests: (dict) - dict of `wire` request frames:
+            i:  reqi
     '''
     if len(set(T)) < pp.t:
         raise CryptoError
 
+    return LoginContext(C, sec, pp, h2c).request(T)
 
-    rho = sec.rho
-    st = (sec, rho, T)
-
-    # Compute Password hash on curve
-    pwd_bytes = bytes(sec.pwd, 'utf-8')
-    s = SHA256.new(pwd_bytes)
-    pwd_hash = int(s.hexdigest(), 16)
-    pwd_point = top.getPoint(pwd_hash)
-
-
-    req_dict = {}
-    for i in T:
-        req_dict[i] =(C, top.scalar_mult(rho, pwd_point) )
-
-    return req_dict, st
-
-def respond(i, ski,  C,x,   reqi, vk, pp):
+@metrics.timed('respond')
+def respond(i, ski,  C,x,   reqi, vk, pp, prove=False):
     '''
     ``Args:``
         i: (int) server index
         ski: (int) secret key share i
-        C: (int) Client ID
+        C: (int) Client ID, unused as reqi carries it
         x: (int) nonce
-        reqi : tuple
-             (C,  reqi)
-        vk: (int) verification key
+        reqi : (bytes) `wire` request frame
+        vk: (`shoup.VerKey`) verification key
         pp: (`PubParam`) global public parameters
+        prove: (bool) attach a proof that the partial token is correct
     ``Returns``
-        reslist: (list) list of responses:
-            [(i, response) ... ]
-            response is (zi, SKE(hi, yi)) tuple
+        resi: (bytes) `wire` response frame holding zi and SKE(hi, yi),
+            plus the proof if prove is set
     '''
 
-    # here request is a (x, y) point
-    C, request = reqi
+    # Decoding decompresses the request point, so it is on the curve
+    # before any arithmetic is done with it
+    try:
+        C, request = wire.decodeRequest(reqi)
+    except ValueError:
+        raise CryptoError
 
-    if C not in serverDict[i].keys():
+    # Unknown clients are mostly turned away by the store's Bloom filter
+    hi = serverDict[i].get(C)
+    if hi is None:
         raise CryptoError
-    else:
-        ki = serverKeyDict[i]
-        hi = serverDict[i][C]
 
-    zi = top.scalar_mult(ki, request)
+    if EXECUTOR is not None:
+        return EXECUTOR.submit(respondTask, i, ski, hi, C, x, request, prove).result()
+    return evalPart(i, ski, hi, C, x, request, vk, pp, prove)
+
+
+def evalPart(i, ski, hi, C, x, request, vk, pp, prove):
+    ''' The work of respond() once the request is decoded and hi looked up '''
+    zi = top.scalar_mult_wnaf(serverKeyDict[i], request, top.WINDOW, serverKeyNafDict[i])
 
     # Set up SKE, run TTG.ParEval
     concat = bytes(str(C) + str(x), 'utf-8')
     yi = shoup.partEval(ski, vk, concat, pp.tpp)
-    y2 = bytes(str(yi[1]), 'utf-8') # yi[1] is the partial token
+    return encryptPart(hi, zi, yi, ski, vk, concat, pp, prove)
+
+
+def encryptPart(hi, zi, yi, ski, vk, concat, pp, prove):
+    ''' Encrypt a partial token with hi and frame the response, see respond() '''
+    size = wire.intSize(pp.tpp[1].N)
+    y2 = wire.encodeInt(yi[1], size) # yi[1] is the partial token
 
-    cipher = AES.new(hi, AES.MODE_EAX, pp.nonce) # encrypt partial token with hi
+    cipher = AES.new(hi, AES.MODE_EAX) # encrypt partial token with hi, fresh nonce
     ct, tag = cipher.encrypt_and_digest(y2)
+    if metrics.ENABLED:
+        metrics.count('aes_encrypt')
 
-    resi = (zi, ct)
-    return resi
+    proof = shoup.partEvalProof(ski, vk, concat, pp.tpp, yi) if prove else None
+    return wire.encodeResponse(zi, cipher.nonce, tag, ct, size, proof)
 
 
-def finalize(st, reslist,  pp, C, x ):
+@metrics.timed('respond_batch')
+def respond_batch(i, ski, batch, vk, pp, prove=False):
     '''
+    Respond to many requests for the same server at once. The scalar
+    multiplications share the recoded ki and are normalized to affine with
+    a single inversion, and the partial token exponent is set up once.
     ``Args:``
-        st: (int) secret state
-        resdict: (dict) dict of response tuples of form i: (zi, ct)
+        i: (int) server index
+        ski: (int) secret key share i
+        batch: (list) of (C, x, reqi) tuples, as passed to respond()
+        vk: (`shoup.VerKey`) verification key
         pp: (`PubParam`) global public parameters
-        C: (int) client id
-        x: (int) nonce
+        prove: (bool) attach a proof that each partial token is correct
     ``Returns``
-        tk: (int) token
+        reslist: (list) of responses in the same order as batch. Each is the
+            frame respond() would return, or None where respond()
+            would raise CryptoError
     '''
 
-    ( sec, rho, T) = st
+    valid = []
+    for j, (C, x, reqi) in enumerate(batch):
+        try:
+            C, request = wire.decodeRequest(reqi)
+        except ValueError:
+            continue
+        hi = serverDict[i].get(C)
+        if hi is None:
+            continue
+        valid.append((j, C, x, request, hi))
+
+    items = [v[1:] for v in valid]
+    if EXECUTOR is not None:
+        parts = EXECUTOR.submit(respondBatchTask, i, ski, items, prove).result()
+    else:
+        parts = evalPartBatch(i, ski, items, vk, pp, prove)
 
-    curve = pp.opp
-    rho_inv = inverse(sec.rho, curve.n)
+    reslist = [None] * len(batch)
+    for (j, _, _, _, _), resi in zip(valid, parts):
+        reslist[j] = resi
 
-    hlist = []
+    return reslist
 
-    for i in reslist.keys():
-        z = reslist[i][0]
-        ct = reslist[i][1]
 
-        # get original password point?
+def evalPartBatch(i, ski, items, vk, pp, prove):
+    ''' The work of respond_batch() once the requests are decoded and each hi
+    looked up, items is a list of (C, x, request, hi) tuples '''
+    zlist = top.scalar_mult_batch(serverKeyDict[i], [v[2] for v in items],
+                                  top.WINDOW, serverKeyNafDict[i])
+    concats = [bytes(str(C) + str(x), 'utf-8') for (C, x, _, _) in items]
+    ylist = shoup.partEvalBatch(ski, vk, concats, pp.tpp)
+
+    return [encryptPart(hi, zi, yi, ski, vk, concat, pp, prove)
+            for (_, _, _, hi), zi, yi, concat in zip(items, zlist, ylist, concats)]
 
-        h = top.scalar_mult(rho_inv, z)
-        xcoord = bytes(str(h[0]), 'utf-8')
-        ycoord = bytes(str(h[1]), 'utf-8')
 
-        s = SHA256.new()
-        s.update(xcoord)
-        s.update(ycoord)
-        s.update(bytes(i))
+@metrics.timed('finalize')
+def finalize(st, reslist,  pp, C, x, vk=None, verified=None):
+    '''
+    ``Args:``
+        st: secret state from request() or `LoginContext.request`
+        resdict: (dict) dict of `wire` response frames, i: resi
+        pp: (`PubParam`) global public parameters
+        C: (int) client id
+        x: (int) nonce
+        vk: (`shoup.VerKey`) `optional` verification key. If given, every
+            response must carry a proof, and a missing or failed proof marks
+            its server as bad
+        verified: (dict) `optional` i: yi partial tokens already accepted
+            in an earlier attempt, see `BadServerError`
+    ``Returns``
+        tk: (int) token
+    ``Raises``
+        BadServerError: some responses were malformed, failed to decrypt
+            or failed their proofs, nothing was combined
+    '''
 
-        h_digest = s.digest()
-        cipher = AES.new(h_digest, AES.MODE_EAX, nonce=pp.nonce)
-        yi = int(cipher.decrypt(ct))
-        hlist.append((i, yi))
+    (ctx, T) = st
+    size = wire.intSize(pp.tpp[1].N)
+
+    hlist = list((verified or {}).items())
+    proved, proofs, bad = [], [], []
+
+    # Decoding decompresses each z, so they are all on the curve
+    frames = {}
+    for i in reslist.keys():
+        try:
+            frames[i] = wire.decodeResponse(reslist[i], size)
+        except ValueError:
+            bad.append(i)
+    inds = list(frames.keys())
+
+    for i, h in zip(inds, ctx.unblind_batch([frames[i][0] for i in inds])):
+        zi, nonce, tag, ct, proof = frames[i]
+
+        cipher = AES.new(deriveKey(h, i), AES.MODE_EAX, nonce=nonce)
+        if metrics.ENABLED:
+            metrics.count('aes_decrypt')
+        try:
+            yi = wire.decodeInt(cipher.decrypt_and_verify(ct, tag))
+        except ValueError:
+            bad.append(i)
+            continue
+        # A server knowing hi could send 0 or N, which combine() cannot invert
+        if not 0 < yi < pp.tpp[1].N:
+            bad.append(i)
+            continue
+
+        if vk is None:
+            hlist.append((i, yi))
+        elif proof is None:
+            bad.append(i)
+        else:
+            proved.append((i, yi))
+            proofs.append(proof)
 
     concat = bytes(str(C) + str(x), 'utf-8')
-    tk = shoup.combine(hlist, pp.tpp, pp.t, concat)
+
+    # Check all proofs at once, so a bad server is caught before combine
+    if vk is not None:
+        bad += checkParts(proved, proofs, vk, concat, pp)
+        hlist += [(i, yi) for (i, yi) in proved if i not in bad]
+    if bad:
+        raise BadServerError(bad, dict(hlist))
+
+    try:
+        tk = shoup.combine(hlist, pp.tpp, pp.t, concat)
+    except ValueError:
+        # some partial token was not invertible mod N
+        raise CryptoError
 
     if tk == False:
         raise CryptoError
@@ -276,6 +808,80 @@ def finalize(st, reslist,  pp, C, x ):
 # Verification Phase
 #
 ##########################################################################################
+
+# Services that check the same token many times during its validity window can
+# keep the digests of tokens that verified, see startTokenCache()
+TOKEN_CACHE = None
+
+
+class TokenCache:
+    ''' Digests of recently verified tokens
+    Only valid tokens are kept, each for ttl seconds after it was verified.
+    When full the entry closest to expiring is dropped.
+    ``Args:``
+        maxsize: (int) most tokens kept
+        ttl: (float) seconds a verified token stays cached
+    '''
+    def __init__(self, maxsize=100000, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.expiry = collections.OrderedDict() # digest: expiry time, oldest first
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def digest(vk, concat, tk):
+        h = SHA256.new(wire.encodeInt(vk.N, wire.intSize(vk.N)))
+        h.update(len(concat).to_bytes(4, 'big') + concat)
+        h.update(wire.encodeInt(tk % vk.N, wire.intSize(vk.N)))
+        return h.digest()
+
+    def __contains__(self, key):
+        now = time.monotonic()
+        with self.lock:
+            expires = self.expiry.get(key)
+            if expires is not None and expires <= now:
+                del self.expiry[key]
+                expires = None
+            if expires is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def __len__(self):
+        return len(self.expiry)
+
+    def add(self, key):
+        with self.lock:
+            # Same ttl for every entry, so insertion order is expiry order
+            self.expiry.pop(key, None)
+            self.expiry[key] = time.monotonic() + self.ttl
+            while len(self.expiry) > self.maxsize:
+                self.expiry.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.expiry.clear()
+            self.hits = self.misses = 0
+
+
+def startTokenCache(maxsize=100000, ttl=300.0):
+    ''' Cache verified tokens in verify() and verifyBatch() until
+    stopTokenCache() is called. verifyBatch() only adds tokens it checked one
+    by one, not ones screened together (see shoup.batchScreens).
+    Returns the `TokenCache` '''
+    global TOKEN_CACHE
+    TOKEN_CACHE = TokenCache(maxsize, ttl)
+    return TOKEN_CACHE
+
+
+def stopTokenCache():
+    global TOKEN_CACHE
+    TOKEN_CACHE = None
+
+
+@metrics.timed('verify')
 def verify(vk, C, x, tk, pp):
     '''
     ``Args:``
@@ -289,7 +895,51 @@ def verify(vk, C, x, tk, pp):
         False - token was invalid
     '''
     concat = bytes(str(C) + str(x), 'utf-8')
-    return shoup.verify(vk, concat, tk, pp.tpp)
+    cache = TOKEN_CACHE
+    if cache is None:
+        return shoup.verify(vk, concat, tk, pp.tpp)
+    key = TokenCache.digest(vk, concat, tk)
+    if key in cache:
+        return True
+    valid = shoup.verify(vk, concat, tk, pp.tpp)
+    if valid:
+        cache.add(key)
+    return valid
+
+
+@metrics.timed('verify_batch')
+def verifyBatch(vk, tokens, pp):
+    '''
+    Verify many tokens at once, see shoup.verifyBatch()
+    ``Args:``
+        vk: (`shoup.VerKey`) verification key
+        tokens: (list) of (C, x, tk) tuples
+        pp: (`PubParam`) global public parameters
+    ``Returns``
+        (list) of bools, True where the token was valid, or with a long
+        public exponent where it is ±(a valid token)
+    '''
+    concats = [bytes(str(C) + str(x), 'utf-8') for C, x, tk in tokens]
+    valid = [False] * len(tokens)
+    todo = list(range(len(tokens)))
+    cache = TOKEN_CACHE
+    if cache is not None:
+        keys = [TokenCache.digest(vk, concat, tk) for concat, (C, x, tk) in zip(concats, tokens)]
+        for j in todo:
+            valid[j] = keys[j] in cache
+        todo = [j for j in todo if not valid[j]]
+
+    bad = set(todo[j] for j in shoup.verifyBatch(vk, [concats[j] for j in todo],
+                                                  [tokens[j][2] for j in todo], pp.tpp))
+    # A screened token may be N - tk of a valid one, which verify() rejects,
+    # so only tokens that had the same check as verify() are cached
+    strict = cache is not None and not shoup.batchScreens(pp.tpp[1])
+    for j in todo:
+        if j not in bad:
+            valid[j] = True
+            if strict:
+                cache.add(keys[j])
+    return valid
 
 
 ##########################################################################################
@@ -307,13 +957,27 @@ def signUpUser(username, password, k, t, n, x):
     return C, secrets, shares, vk, pp
 
 # This is the entry point for requesting the token
-def requestTk(C, secrets, shares, vk, pp, T, x):
-    req_dict, st = request(C, secrets,  T, pp)
-    res_dict = {}
-    for i in T:
-        res_dict[i] = respond(i, shares[i-1], C, x, req_dict[i], vk, pp)
-    tk = finalize(st, res_dict, pp, C, x)
-    return tk
+def requestTk(C, secrets, shares, vk, pp, T, x, prove=False):
+    ctx = LoginContext(C, secrets, pp)
+    req_dict, st = ctx.request(T)
+    res_dict = respondAll(T, shares, C, x, req_dict, vk, pp, prove)
+    if not prove:
+        return finalize(st, res_dict, pp, C, x)
+
+    # Replace bad servers with unused ones, keeping the verified partials
+    verified, used = {}, set(T)
+    while True:
+        try:
+            return finalize(st, res_dict, pp, C, x, vk, verified)
+        except BadServerError as err:
+            verified = err.good
+            spare = [i for i in range(1, pp.n+1) if i not in used]
+            T = spare[:len(err.bad)]
+            if len(T) < len(err.bad):
+                raise CryptoError
+            used.update(T)
+            req_dict, st = ctx.request(T, verified)
+            res_dict = respondAll(T, shares, C, x, req_dict, vk, pp, prove)
 
 # This is the entry point for the verification
 def verifyTk(vk, C, x, tk, pp):
@@ -349,14 +1013,14 @@ def print_test():
     req_dict, st = request(C, secrets,  T, pp)
     
     for k,v in req_dict.items():
-        print("From server: {} sending request: {}".format(k, str(str(v[0]) + " :" + str(v[1]))))
+        print("From server: {} sending request: {}".format(k, hexlify(v)))
 
     res_dict = {}
     for i in T:
         res_dict[i] = respond(i, shares[i-1], C, x, req_dict[i], vk, pp)
 
     for k, v in res_dict.items():
-        print("Server: {} Returned: {}".format(k, str(str(v[0]) + " :" + str(hexlify(v[1])))))
+        print("Server: {} Returned: {}".format(k, hexlify(v)))
 
     print("Assembling token...\n")
     tk = finalize(st, res_dict, pp, C, x)
@@ -367,4 +1031,5 @@ def print_test():
 
         
 # Run test and print results
-print_test()
+if __name__ == '__main__':
+    print_test()
@@ -0,0 +1,167 @@
+# One PASTA protocol server as its own HTTP service. Server i loads only its
+# own key file from the ceremony (pasta.serverKeyPath), so it holds only its
+# key share, its curve key ki and its own client records, and answers
+# `wire` frames:
+#
+#   POST /known                     client ID (32 bytes) -> 1 if registered, else 0 (1 byte)
+#   POST /store                     record frame(s) -> number of new records (4 bytes),
+#                                   201 any stored, 200 all already registered
+#   POST /respond?x=<hex>&prove=1   request frame   -> response frame
+#
+#   python protocolServer.py pasta_keys.server1.json -i 1 --port 5001
+#   python protocolServer.py pasta_keys.json --all --port 5001
+#
+# --all starts servers 1..n on consecutive ports, each with its own
+# pasta_keys.server<i>.json, and prints the PASTA_SERVERS value for
+# pythonServer.py (see cluster.py for the client side).
+import argparse
+import os
+import signal
+import subprocess
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import pasta
+import wire
+from pasta import CryptoError
+
+
+def makeHandler(i, ski, vk, pp):
+    ''' Request handler class for server i
+    ``Args:``
+        i: (int) server index
+        ski: (tuple) server i's key share from the key ceremony
+        vk: (`shoup.VerKey`) verification key
+        pp: (`PubParam`) global public parameters
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        # HTTP/1.1 keeps connections open, so the client's pooled
+        # connections are reused (Werkzeug's dev server always closes them)
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if url.path == '/known':
+                self.known(body)
+            elif url.path == '/store':
+                self.store(body)
+            elif url.path == '/respond':
+                self.respond(parse_qs(url.query), body)
+            else:
+                self.reply(404)
+
+        def known(self, body):
+            if len(body) != wire.ID_SIZE:
+                return self.reply(400)
+            self.reply(200, wire.encodeInt(wire.decodeInt(body) in pasta.serverDict[i], 1))
+
+        def store(self, body):
+            # One or more record frames back to back, written in one batch
+            size = wire.RECORD_SIZE
+            if not body or len(body) % size:
+                return self.reply(400)
+            view = memoryview(body)
+            try:
+                batch = [wire.decodeRecord(view[j:j + size]) for j in range(0, len(body), size)]
+            except ValueError:
+                return self.reply(400)
+            added = pasta.serverDict[i].addMany(batch)
+            self.reply(201 if added else 200, wire.encodeInt(added, 4))
+
+        def respond(self, query, body):
+            try:
+                x = int(query['x'][0], 16)
+            except (KeyError, ValueError):
+                return self.reply(400)
+            prove = query.get('prove', ['0'])[0] == '1'
+            try:
+                resi = pasta.respond(i, ski, None, x, body, vk, pp, prove)
+            except CryptoError:
+                return self.reply(403)
+            self.reply(200, resi)
+
+        def reply(self, status, body=b''):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run PASTA protocol servers')
+    parser.add_argument('keys', help='this server\'s key file written by keygen.py, '
+                        'or with --all the full key file next to the per-server ones')
+    parser.add_argument('-i', type=int, help='server index, 1..n')
+    parser.add_argument('--all', action='store_true', help='start servers 1..n')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001,
+                        help='port of this server, or of server 1 with --all')
+    parser.add_argument('--db', default=None,
+                        help='keep client records in <db>/server<i>.db instead of memory')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='answer concurrent requests on this many cores (see pasta.startExecutor)')
+    args = parser.parse_args()
+
+    # Stop on SIGTERM the same way as on Ctrl-C, so record stores are saved
+    # and --all takes its servers down with it
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    if args.all:
+        # Only the per-server files are read, by the servers they belong to
+        n = 0
+        while os.path.exists(pasta.serverKeyPath(args.keys, n + 1)):
+            n += 1
+        if n == 0:
+            parser.error('no per-server key files next to {}, e.g. {}'.format(
+                args.keys, pasta.serverKeyPath(args.keys, 1)))
+        extra = ['--workers', str(args.workers)] if args.workers else []
+        extra += ['--db', args.db] if args.db else []
+        procs = [subprocess.Popen([sys.executable, __file__, pasta.serverKeyPath(args.keys, i),
+                                   '-i', str(i), '--host', args.host,
+                                   '--port', str(args.port + i - 1)] + extra)
+                 for i in range(1, n+1)]
+        print('PASTA_SERVERS=' + ','.join('http://{}:{}'.format(args.host, args.port + i)
+                                          for i in range(n)))
+        try:
+            for p in procs:
+                p.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for p in procs:
+                p.terminate()
+                p.wait()
+        return
+
+    if args.i is None:
+        parser.error('-i is required without --all')
+    try:
+        shares, vk, pp = pasta.loadKeys(args.keys, args.i)
+    except CryptoError as err:
+        parser.error(str(err))
+
+    if args.db:
+        pasta.openStores(args.db, [args.i])
+    if args.workers:
+        pasta.startExecutor(vk, pp, args.workers)
+    handler = makeHandler(args.i, shares[0], vk, pp)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print('Server {} listening on http://{}:{}'.format(args.i, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+    finally:
+        pasta.closeStores()
+
+
+if __name__ == '__main__':
+    main()
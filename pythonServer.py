@@ -1,29 +1,61 @@
 #############################
 # Written by Bennett Larson #
 #############################
+import os
 from flask import Flask
 from flask import jsonify
 from flask import request
+from flask import Response
 from Crypto.Random.random import randrange, getrandbits
 from Crypto.Hash import SHA256
-import collections
 app = Flask(__name__)
-from pasta import signUpUser, requestTk, verifyTk, CryptoError
+from pasta import SecParam, signUp, store, keyCeremony, loadKeys, requestTk, verifyTk, CryptoError, startExecutor, openStores
+from cluster import ServerPool, registerRemote, requestTkRemote
+import metrics
 
-global secrets, shares, vk, pp, x
+# Keys come from a one-off key ceremony (see keygen.py) and are only loaded
+# here, so registering a user no longer re-keys the servers
+KEY_FILE = os.environ.get('PASTA_KEYS', 'pasta_keys.json')
+if not os.path.exists(KEY_FILE):
+    print('No key file at {}, running key ceremony'.format(KEY_FILE))
+    keyCeremony(KEY_FILE, 512, 5, 4)
+shares, vk, pp = loadKeys(KEY_FILE)
+x = getrandbits(128)
+
+# PASTA_METRICS=1 turns on operation counters and phase latency histograms,
+# served on /metrics
+if os.environ.get('PASTA_METRICS') == '1':
+    metrics.enable()
+
+# With PASTA_SERVERS set (comma separated URLs of servers 1..n, see
+# protocolServer.py) the protocol runs against those services instead of
+# in this process
+SERVERS = os.environ.get('PASTA_SERVERS')
+pool = ServerPool.fromList(SERVERS.split(',')) if SERVERS else None
+
+# PASTA_DB keeps the in-process servers' client records in SQLite files in
+# that directory, so registrations survive a restart
+if os.environ.get('PASTA_DB'):
+    openStores(os.environ['PASTA_DB'], range(1, pp.n+1))
+
+# PASTA_WORKERS spreads the per-server work of in-process logins over that
+# many cores (see pasta.startExecutor)
+if os.environ.get('PASTA_WORKERS'):
+    startExecutor(vk, pp, int(os.environ['PASTA_WORKERS']))
 
 @app.route('/login', methods=['GET'])
 def login():
-    SecParam = collections.namedtuple('SecParam', 'pwd rho')
-    global shares, vk, pp, x
     username = request.args.get('username', type = str)
     password = request.args.get('password', type = str)
     valid = False
     try:
         C = int(SHA256.new(bytes(username, 'utf-8')).hexdigest(), 16)
         secrets = SecParam(pwd=password, rho=randrange(1, pp.opp.n))
-        T = [1,2,3,4]
-        tk = requestTk(C, secrets, shares, vk, pp, T, x)
+        if pool:
+            tk = requestTkRemote(C, secrets, vk, pp, x, pool)
+        else:
+            T = [1,2,3,4]
+            tk = requestTk(C, secrets, shares, vk, pp, T, x)
         valid = verifyTk(vk, C, x, tk, pp)
     except CryptoError:
         valid = False
@@ -31,14 +63,22 @@ def login():
 
 @app.route('/register', methods=['GET'])
 def register():
-    global shares, vk, pp, x
     result = False
     try:
         username = request.args.get('username', type = str)
         password = request.args.get('password', type = str)
-        x = getrandbits(128)
-        _, _, shares, vk, pp = signUpUser(username, password, 512, 4, 5, x)
-        result = True
-    except Exception(e):
+        C = int(SHA256.new(bytes(username, 'utf-8')).hexdigest(), 16)
+        secrets = SecParam(pwd=password, rho=randrange(1, pp.opp.n))
+        # An already registered username keeps its password and gets False
+        if pool:
+            registerRemote(C, secrets, pp, pool)
+            result = True
+        else:
+            result = store(C, signUp(C, secrets, pp), pp)
+    except Exception:
         result = False
-    return jsonify(True)
+    return jsonify(result)
+
+@app.route('/metrics', methods=['GET'])
+def metricsPage():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
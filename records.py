@@ -0,0 +1,229 @@
+# Client record stores, one per server i, mapping the 32-byte client ID C to
+# the record hi from signUp(). pasta.serverDict[i] holds one of these.
+#
+#   MemoryStore: a dict, gone on restart
+#   SQLiteStore: durable, indexed on C, with a Bloom filter in front so
+#                unknown clients are rejected without touching the database
+import math
+import os
+import sqlite3
+import struct
+import threading
+
+ID_SIZE = 32 # client IDs are SHA-256 digests
+
+
+def clientKey(C):
+    ''' Fixed-width key for client ID C '''
+    return C.to_bytes(ID_SIZE, 'big')
+
+
+class MemoryStore:
+    ''' In-memory record store '''
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, C):
+        return C in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, C):
+        ''' hi for client C, or None if C is not registered '''
+        return self.records.get(C)
+
+    def add(self, C, hi):
+        ''' Store a record, returns False if C was already registered '''
+        # Of two threads adding the same C only one may get True
+        with self.lock:
+            if C in self.records:
+                return False
+            self.records[C] = hi
+            return True
+
+    def addMany(self, items):
+        ''' Store (C, hi) records, returns how many were new '''
+        return sum(self.addEach(items))
+
+    def addEach(self, items):
+        ''' Store (C, hi) records, returns a bool for each, False where C
+        was already registered '''
+        return [self.add(C, hi) for C, hi in items]
+
+    def close(self):
+        pass
+
+
+class BloomFilter:
+    ''' Bloom filter over 32-byte client keys
+    Keys are SHA-256 digests, so two 64-bit slices of the key serve as the
+    hashes for double hashing.
+    ``Args:``
+        capacity: (int) number of keys it is sized for
+        error: (float) false positive rate at capacity
+    '''
+    LN2 = 0.6931471805599453
+
+    def __init__(self, capacity, error=0.01, bits=None):
+        if bits is None:
+            m = max(64, int(-capacity * math.log(error) / (self.LN2 * self.LN2)))
+            bits = bytearray((m + 7) // 8)
+        self.bits = bits
+        self.m = len(bits) * 8
+        self.k = max(1, round(self.m / max(capacity, 1) * self.LN2))
+        self.capacity = capacity
+
+    def positions(self, key):
+        h1 = int.from_bytes(key[:8], 'big')
+        h2 = int.from_bytes(key[8:16], 'big') | 1
+        m = self.m
+        return [(h1 + j * h2) % m for j in range(self.k)]
+
+    def add(self, key):
+        bits = self.bits
+        for p in self.positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def mightContain(self, key):
+        bits = self.bits
+        for p in self.positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+class SQLiteStore:
+    ''' Durable record store for one server
+    Records live in an SQLite database in WAL mode, indexed on C. A Bloom
+    filter in front of it answers most lookups of unknown clients. The
+    filter is saved to path + '.bloom' by checkpoint() and close(), along
+    with the last row it covers, so opening the store only scans rows added
+    since, e.g. after a crash. One process writes to a database at a time.
+    ``Args:``
+        path: (str) database file
+        capacity: (int) expected number of records, the filter is rebuilt
+            at twice the size when it fills up
+        error: (float) Bloom filter false positive rate at capacity
+    '''
+    BLOOM_MAGIC = b'PASTABF1'
+    BLOOM_HEADER = struct.Struct('>8sQQ')
+
+    def __init__(self, path, capacity=1 << 20, error=0.01):
+        self.path = path
+        self.error = error
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # Records are never deleted, so rowid order is insertion order
+        self.db.execute('CREATE TABLE IF NOT EXISTS records ('
+                        'id INTEGER PRIMARY KEY, c BLOB NOT NULL UNIQUE, h BLOB NOT NULL)')
+        self.count = self.lastId()
+        self.bloom, covered = self.loadBloom(max(capacity, 2 * self.count))
+        self.catchUp(self.bloom, covered)
+        if self.count > self.bloom.capacity:
+            self.grow()
+
+    def lastId(self):
+        return self.db.execute('SELECT coalesce(max(id), 0) FROM records').fetchone()[0]
+
+    def loadBloom(self, capacity):
+        ''' Saved filter and the last row it covers, or an empty filter '''
+        try:
+            with open(self.path + '.bloom', 'rb') as f:
+                data = f.read()
+            magic, last, cap = self.BLOOM_HEADER.unpack_from(data)
+            if magic == self.BLOOM_MAGIC and last <= self.count and cap >= self.count:
+                bits = bytearray(data[self.BLOOM_HEADER.size:])
+                return BloomFilter(cap, self.error, bits), last
+        except (OSError, struct.error):
+            pass
+        return BloomFilter(capacity, self.error), 0
+
+    def catchUp(self, bloom, after):
+        ''' Add rows after id `after` to the Bloom filter bloom '''
+        for (c,) in self.db.execute('SELECT c FROM records WHERE id > ?', (after,)):
+            bloom.add(c)
+
+    def grow(self):
+        # get() reads the filter without the lock, so the new one is filled
+        # before it replaces the old one
+        bloom = BloomFilter(2 * max(self.count, self.bloom.capacity), self.error)
+        self.catchUp(bloom, 0)
+        self.bloom = bloom
+
+    def __contains__(self, C):
+        return self.get(C) is not None
+
+    def __len__(self):
+        return self.count
+
+    def get(self, C):
+        ''' hi for client C, or None if C is not registered '''
+        key = clientKey(C)
+        if not self.bloom.mightContain(key):
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT h FROM records WHERE c = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, C, hi):
+        ''' Store a record, returns False if C was already registered '''
+        return self.addMany([(C, hi)]) == 1
+
+    def addMany(self, items):
+        ''' Store (C, hi) records in one transaction, returns how many were new '''
+        rows = [(clientKey(C), bytes(hi)) for C, hi in items]
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                before = self.db.total_changes
+                self.db.executemany('INSERT OR IGNORE INTO records (c, h) VALUES (?, ?)', rows)
+                added = self.db.total_changes - before
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            # Keys that were already stored are in the filter anyway
+            for key, _ in rows:
+                self.bloom.add(key)
+            self.count += added
+            if self.count > self.bloom.capacity:
+                self.grow()
+        return added
+
+    def addEach(self, items):
+        ''' Store (C, hi) records in one transaction, returns a bool for each,
+        False where C was already registered '''
+        rows = [(clientKey(C), bytes(hi)) for C, hi in items]
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                new = [self.db.execute('INSERT OR IGNORE INTO records (c, h) VALUES (?, ?)',
+                                       row).rowcount == 1 for row in rows]
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            for key, _ in rows:
+                self.bloom.add(key)
+            self.count += sum(new)
+            if self.count > self.bloom.capacity:
+                self.grow()
+        return new
+
+    def checkpoint(self):
+        ''' Save the Bloom filter, so reopening does not rescan the table '''
+        with self.lock:
+            data = self.BLOOM_HEADER.pack(self.BLOOM_MAGIC, self.lastId(), self.bloom.capacity)
+            tmp = self.path + '.bloom.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+                f.write(self.bloom.bits)
+            os.replace(tmp, self.path + '.bloom')
+
+    def close(self):
+        self.checkpoint()
+        self.db.close()
@@ -0,0 +1,73 @@
+# Batch token verification. The exponent from Zn is too short for the batch
+# test, so BATCH_MIN_E_BITS is lowered to run the bisection path.
+#
+#   python -m pytest -q tests
+import pytest
+from Crypto.Random.random import randrange, getrandbits
+
+import pasta
+import ttg.shoup as shoup
+from pasta import SecParam
+
+
+@pytest.fixture(scope='module')
+def keys():
+    shares, vk, pp = pasta.globalSetup(512, 5, 3)
+    C = getrandbits(256)
+    pasta.store(C, pasta.signUp(C, SecParam(pwd='pw', rho=randrange(1, pp.opp.n)), pp), pp)
+    tokens = []
+    for _ in range(8):
+        x = getrandbits(128)
+        sec = SecParam(pwd='pw', rho=randrange(1, pp.opp.n))
+        tokens.append((C, x, pasta.requestTk(C, sec, shares, vk, pp, [1, 2, 3], x)))
+    return vk, pp, tokens
+
+
+@pytest.fixture
+def bisect(monkeypatch):
+    ''' Force the batch path and count the checkTokens() calls '''
+    calls = []
+    checkTokens = shoup.checkTokens
+    monkeypatch.setattr(shoup, 'BATCH_MIN_E_BITS', 2)
+    monkeypatch.setattr(shoup, 'checkTokens', lambda *a: calls.append(1) or checkTokens(*a))
+    yield calls
+    pasta.stopTokenCache()
+
+
+def test_all_valid(keys, bisect):
+    vk, pp, tokens = keys
+    assert pasta.verifyBatch(vk, tokens, pp) == [True] * len(tokens)
+    assert len(bisect) == 1
+
+
+def test_finds_bad_tokens(keys, bisect):
+    vk, pp, tokens = keys
+    tokens = list(tokens)
+    for j in (2, 5):
+        C, x, tk = tokens[j]
+        tokens[j] = (C, x, tk + 1)
+    valid = pasta.verifyBatch(vk, tokens, pp)
+    assert valid == [j not in (2, 5) for j in range(len(tokens))]
+    assert len(bisect) > 1
+
+
+def test_negated_token_not_cached(keys, bisect):
+    vk, pp, tokens = keys
+    C, x, tk = tokens[0]
+    pasta.startTokenCache()
+    # N - tk passes the screen, but must not change what verify() says
+    pasta.verifyBatch(vk, [(C, x, vk.N - tk)] + tokens[1:], pp)
+    assert not pasta.verify(vk, C, x, vk.N - tk, pp)
+    assert pasta.verify(vk, C, x, tk, pp)
+
+
+def test_short_exponent_caches(keys):
+    vk, pp, tokens = keys
+    cache = pasta.startTokenCache()
+    try:
+        assert pasta.verifyBatch(vk, tokens, pp) == [True] * len(tokens)
+        assert len(cache) == len(tokens)
+        assert all(pasta.verify(vk, C, x, tk, pp) for C, x, tk in tokens)
+        assert cache.hits == len(tokens)
+    finally:
+        pasta.stopTokenCache()
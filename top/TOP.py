@@ -13,6 +13,8 @@ import random
 import binascii
 import sys
 
+import metrics
+
 
 
 ##########################################################################################
@@ -38,6 +40,38 @@ curve = EllipticCurve(
     h=1,
 )
 
+# Default window width for wNAF scalar multiplication. A width w window uses
+# a table of 2^(w-2) odd multiples and adds on average once every w+1 bits.
+WINDOW = 4
+
+
+
+class Point(object):
+    """An affine point on the curve. None still represents the point at infinity.
+
+    Points are trusted: the arithmetic below does not re-check that they lie
+    on the curve. Points from outside (e.g. over the network) come in through
+    point_from_bytes(), which wire.decodeRequest() and wire.decodeResponse()
+    use, and can only decode points on the curve.
+    """
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __iter__(self):
+        return iter((self.x, self.y))
+
+    def __eq__(self, other):
+        return isinstance(other, Point) and self.x == other.x and self.y == other.y
+
+    def __hash__(self):
+        return hash((self.x, self.y))
+
+    def __repr__(self):
+        return 'Point({}, {})'.format(self.x, self.y)
+
 
 
 ##########################################################################################
@@ -57,6 +91,9 @@ def inverse_mod(k, p):
         # k ** -1 = p - (-k) ** -1  (mod p)
         return p - inverse_mod(-k, p)
 
+    if metrics.ENABLED:
+        metrics.count('field_inv')
+
     # Extended Euclidean algorithm.
     s, old_s = 0, 1
     t, old_t = 1, 0
@@ -89,11 +126,43 @@ def is_on_curve(point):
 
 
 
+# Size of a SEC1 compressed point: one prefix byte and the x coordinate
+POINT_SIZE = 1 + (curve.p.bit_length() + 7) // 8
+
+
+
+def point_to_bytes(point):
+    """Returns the SEC1 compressed encoding of a finite point:
+    0x02 or 0x03 (the parity of y) followed by x as a big-endian integer.
+    """
+    return bytes([2 + (point.y & 1)]) + point.x.to_bytes(POINT_SIZE - 1, 'big')
+
+
+
+def point_from_bytes(data):
+    """Returns the Point encoded by point_to_bytes(). Decompression recovers y
+    from the curve equation, so the result is always on the curve.
+    Raises ValueError for anything that is not a valid compressed point.
+    """
+    if len(data) != POINT_SIZE or data[0] not in (2, 3):
+        raise ValueError('malformed point')
+
+    x = int.from_bytes(data[1:], 'big')
+    if x >= curve.p:
+        raise ValueError('coordinate out of range')
+
+    y = sqrt_mod(x * x * x + curve.a * x + curve.b)
+    if y is None:
+        raise ValueError('point not on curve')
+    if (y & 1) != (data[0] & 1):
+        y = curve.p - y
+
+    return Point(x, y)
+
+
+
 def point_add(point1, point2):
     """Returns the result of point1 + point2 according to the group law."""
-    assert is_on_curve(point1)
-    assert is_on_curve(point2)
-
     if point1 is None:
         # 0 + point2 = point2
         return point2
@@ -101,8 +170,10 @@ def point_add(point1, point2):
         # point1 + 0 = point1
         return point1
 
-    x1, y1 = point1
-    x2, y2 = point2
+    x1, y1 = point1.x, point1.y
+    x2, y2 = point2.x, point2.y
+    if metrics.ENABLED:
+        metrics.count('ec_add')
 
     if x1 == x2 and y1 != y2:
         # point1 + (-point1) = 0
@@ -117,19 +188,27 @@ def point_add(point1, point2):
 
     x3 = m * m - x1 - x2
     y3 = y1 + m * (x3 - x1)
-    result = (x3 % curve.p,
-              -y3 % curve.p)
 
-    assert is_on_curve(result)
+    return Point(x3 % curve.p,
+                 -y3 % curve.p)
 
-    return result
 
 
+def point_neg(point):
+    """Returns -point."""
+    if point is None:
+        # -0 = 0
+        return None
+
+    return Point(point.x, -point.y % curve.p)
+
 
-def scalar_mult(k, point):
-    """Returns k * point computed using the double and point_add algorithm."""
-    assert is_on_curve(point)
 
+def scalar_mult(k, point):
+    """Returns k * point computed using left-to-right double-and-add in
+    Jacobian coordinates. Only one field inversion is performed, when the
+    result is converted back to affine coordinates.
+    """
     if k % curve.n == 0 or point is None:
         return None
 
@@ -138,24 +217,330 @@ def scalar_mult(k, point):
         return scalar_mult(-k, point_neg(point))
 
     result = None
-    addend = point
+    addend = (point.x, point.y)
 
-    while k:
-        if k & 1:
+    for bit in bin(k)[2:]:
+        # Double.
+        result = jacobian_double(result)
+
+        if bit == '1':
             # Add.
-            result = point_add(result, addend)
+            result = jacobian_add_affine(result, addend)
 
-        # Double.
-        addend = point_add(addend, addend)
+    return from_jacobian(result)
 
+
+
+# Jacobian coordinates: (X, Y, Z) represents the affine point (X / Z^2, Y / Z^3).
+# None still represents the point at infinity, so no inversions are needed
+# until a result is converted back with from_jacobian().
+def to_jacobian(point):
+    """Returns the Jacobian representation of an affine point."""
+    if point is None:
+        return None
+
+    return (point.x, point.y, 1)
+
+
+
+def from_jacobian(point):
+    """Returns the affine representation of a Jacobian point."""
+    if point is None:
+        return None
+
+    X, Y, Z = point
+    z_inv = inverse_mod(Z, curve.p)
+    z_inv2 = z_inv * z_inv % curve.p
+
+    return Point(X * z_inv2 % curve.p,
+                 Y * z_inv2 * z_inv % curve.p)
+
+
+
+def jacobian_double(point):
+    """Returns 2 * point for a Jacobian point. Uses the dbl-2001-b formulas
+    for a = -3, falling back to the general formula for other curves.
+    """
+    if point is None:
+        return None
+    if metrics.ENABLED:
+        metrics.count('ec_double')
+
+    X1, Y1, Z1 = point
+    p = curve.p
+
+    if Y1 == 0:
+        # Point of order two.
+        return None
+
+    delta = Z1 * Z1 % p
+    gamma = Y1 * Y1 % p
+    beta = X1 * gamma % p
+
+    if curve.a == -3:
+        # 3 * X1^2 - 3 * Z1^4 = 3 * (X1 - Z1^2) * (X1 + Z1^2)
+        alpha = 3 * (X1 - delta) * (X1 + delta) % p
+    else:
+        alpha = (3 * X1 * X1 + curve.a * delta * delta) % p
+
+    X3 = (alpha * alpha - 8 * beta) % p
+    Z3 = ((Y1 + Z1) * (Y1 + Z1) - gamma - delta) % p
+    Y3 = (alpha * (4 * beta - X3) - 8 * gamma * gamma) % p
+
+    return (X3, Y3, Z3)
+
+
+
+def jacobian_add(point1, point2):
+    """Returns point1 + point2 for two Jacobian points (add-2007-bl)."""
+    if point1 is None:
+        return point2
+    if point2 is None:
+        return point1
+    if metrics.ENABLED:
+        metrics.count('ec_add')
+
+    X1, Y1, Z1 = point1
+    X2, Y2, Z2 = point2
+    p = curve.p
+
+    Z1Z1 = Z1 * Z1 % p
+    Z2Z2 = Z2 * Z2 % p
+    U1 = X1 * Z2Z2 % p
+    U2 = X2 * Z1Z1 % p
+    S1 = Y1 * Z2 * Z2Z2 % p
+    S2 = Y2 * Z1 * Z1Z1 % p
+
+    H = (U2 - U1) % p
+    r = (S2 - S1) % p
+
+    if H == 0:
+        if r == 0:
+            # This is the case point1 == point2.
+            return jacobian_double(point1)
+        # point1 + (-point1) = 0
+        return None
+
+    HH = H * H % p
+    HHH = H * HH % p
+    V = U1 * HH % p
+
+    X3 = (r * r - HHH - 2 * V) % p
+    Y3 = (r * (V - X3) - S1 * HHH) % p
+    Z3 = Z1 * Z2 * H % p
+
+    return (X3, Y3, Z3)
+
+
+
+def jacobian_add_affine(point1, point2):
+    """Returns point1 + point2 where point1 is Jacobian and point2 is an affine
+    (x, y) tuple (mixed addition, madd-2004-hmv). This saves the Z2
+    multiplications.
+    """
+    if point2 is None:
+        return point1
+    if point1 is None:
+        return (point2[0], point2[1], 1)
+    if metrics.ENABLED:
+        metrics.count('ec_add')
+
+    X1, Y1, Z1 = point1
+    x2, y2 = point2
+    p = curve.p
+
+    Z1Z1 = Z1 * Z1 % p
+    U2 = x2 * Z1Z1 % p
+    S2 = y2 * Z1 * Z1Z1 % p
+
+    H = (U2 - X1) % p
+    r = (S2 - Y1) % p
+
+    if H == 0:
+        if r == 0:
+            # This is the case point1 == point2.
+            return jacobian_double(point1)
+        # point1 + (-point1) = 0
+        return None
+
+    HH = H * H % p
+    HHH = H * HH % p
+    V = X1 * HH % p
+
+    X3 = (r * r - HHH - 2 * V) % p
+    Y3 = (r * (V - X3) - Y1 * HHH) % p
+    Z3 = Z1 * H % p
+
+    return (X3, Y3, Z3)
+
+
+
+def batch_inverse_mod(values, p, invert=inverse_mod):
+    """Returns the inverses of all values modulo p using Montgomery's trick,
+    i.e. a single call to invert and 3 * (len(values) - 1) multiplications.
+    invert(k, p) inverts one value, inverse_mod for the curve field. For a
+    composite modulus pass one that raises on non-invertible values, e.g.
+    Crypto.Util.number.inverse as ttg.znUtil.multiexp does.
+    """
+    if not values:
+        return []
+
+    # prefix[j] = values[0] * ... * values[j]
+    prefix = []
+    acc = 1
+    for v in values:
+        acc = acc * v % p
+        prefix.append(acc)
+
+    inv = invert(acc, p)
+    result = [0] * len(values)
+    for j in range(len(values) - 1, 0, -1):
+        result[j] = inv * prefix[j - 1] % p
+        inv = inv * values[j] % p
+    result[0] = inv
+
+    return result
+
+
+
+def batch_from_jacobian(points):
+    """Returns the affine representation of a list of Jacobian points,
+    sharing a single field inversion between all of them.
+    """
+    finite = [P for P in points if P is not None]
+    z_invs = iter(batch_inverse_mod([P[2] for P in finite], curve.p))
+
+    result = []
+    for P in points:
+        if P is None:
+            result.append(None)
+            continue
+        X, Y, Z = P
+        z_inv = next(z_invs)
+        z_inv2 = z_inv * z_inv % curve.p
+        result.append(Point(X * z_inv2 % curve.p,
+                            Y * z_inv2 * z_inv % curve.p))
+
+    return result
+
+
+
+def wnaf(k, w=WINDOW):
+    """Returns the width-w non-adjacent form of k modulo the group order,
+    least significant digit first. Every non-zero digit is odd, has absolute
+    value below 2^(w-1), and is followed by at least w-1 zeros.
+    """
+    k = k % curve.n
+    digits = []
+    while k:
+        if k & 1:
+            d = k % (1 << w)
+            if d >= (1 << (w - 1)):
+                d -= (1 << w)
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
         k >>= 1
 
-    assert is_on_curve(result)
+    return digits
+
+
+
+def odd_multiples_jacobian(point, w=WINDOW):
+    """Returns the Jacobian points [P, 3P, 5P, ..., (2^(w-1) - 1)P]."""
+    count = 1 << (w - 2)
+    P = to_jacobian(point)
+    table = [P]
+    if count > 1:
+        P2 = jacobian_double(P)
+        for _ in range(count - 1):
+            table.append(jacobian_add(table[-1], P2))
+
+    return table
+
+
+
+def odd_multiples(point, w=WINDOW):
+    """Returns the affine points [P, 3P, 5P, ..., (2^(w-1) - 1)P] used by
+    scalar_mult_wnaf as plain (x, y) tuples, normalized with a single shared
+    inversion.
+    """
+    return [(Q.x, Q.y) for Q in batch_from_jacobian(odd_multiples_jacobian(point, w))]
+
+
+
+def wnaf_jacobian(digits, table):
+    """Returns the Jacobian point sum(d * 2^j * P) for the wNAF digits of a
+    scalar, given the affine odd-multiples table of P.
+    """
+    result = None
+    for d in reversed(digits):
+        result = jacobian_double(result)
+
+        if d > 0:
+            result = jacobian_add_affine(result, table[d >> 1])
+        elif d < 0:
+            x, y = table[-d >> 1]
+            result = jacobian_add_affine(result, (x, -y % curve.p))
 
     return result
 
 
 
+def scalar_mult_wnaf(k, point, w=WINDOW, digits=None):
+    """Returns k * point computed with a width-w NAF of k.
+    digits may hold a precomputed wnaf(k, w), e.g. for a long-lived key,
+    in which case only the odd multiples of point are computed per call.
+    """
+    if digits is None:
+        digits = wnaf(k, w)
+
+    if not digits or point is None:
+        return None
+
+    return from_jacobian(wnaf_jacobian(digits, odd_multiples(point, w)))
+
+
+
+def scalar_mult_batch(k, points, w=WINDOW, digits=None):
+    """Returns [k * P for P in points] for a single scalar k.
+    The scalar is recoded once and every point goes through the same
+    double/add schedule in lockstep. The odd-multiples tables of all points
+    are normalized with one shared inversion, and so are the results, so the
+    whole batch costs two inversions instead of two per point.
+    """
+    if digits is None:
+        digits = wnaf(k, w)
+
+    if not digits:
+        return [None] * len(points)
+
+    count = 1 << (w - 2)
+    finite = [P for P in points if P is not None]
+
+    jtables = []
+    for P in finite:
+        jtables.extend(odd_multiples_jacobian(P, w))
+    flat = [(Q.x, Q.y) for Q in batch_from_jacobian(jtables)]
+    tables = [flat[j * count:(j + 1) * count] for j in range(len(finite))]
+
+    acc = [None] * len(finite)
+    for d in reversed(digits):
+        acc = [jacobian_double(R) for R in acc]
+
+        if d > 0:
+            acc = [jacobian_add_affine(R, table[d >> 1])
+                   for R, table in zip(acc, tables)]
+        elif d < 0:
+            acc = [jacobian_add_affine(R, (table[-d >> 1][0], -table[-d >> 1][1] % curve.p))
+                   for R, table in zip(acc, tables)]
+    results = iter(batch_from_jacobian(acc))
+
+    return [None if P is None else next(results) for P in points]
+
+
+
 def exp1(e,g,n):
     """ This calculates g^e (mod n) for integers e,g, and n """
     t = 1
@@ -253,11 +638,80 @@ def getPoint(x):
         y2 = (x * x * x + curve.a * x + curve.b) % curve.p
         y = sqrt1(y2, curve.p)
         if pow(y, 2, curve.p) == y2:
-            return (x, y)
+            return Point(x, y)
         x = x + 1 % curve.n
 
 
 
+def sqrt_mod(c):
+    """ Returns a square root of c mod curve.p, or None if c is not a
+    quadratic residue. Since p = 3 (mod 4) this is a single exponentiation."""
+    c = c % curve.p
+    y = pow(c, (curve.p + 1) // 4, curve.p)
+    if y * y % curve.p != c:
+        return None
+    return y
+
+
+
+def getPointSqrt(x):
+    """ Returns a point on the elliptic curve with x (mod p) as the x coordinate,
+    trying x, x+1, ... until one is on the curve. Same search as getPoint,
+    but the square root is taken with a single built-in pow. """
+    x = x % curve.p
+    while True:
+        y = sqrt_mod(x * x * x + curve.a * x + curve.b)
+        if y is not None:
+            return Point(x, y)
+        x = (x + 1) % curve.p
+
+
+
+# Simplified SWU constants for the curve (RFC 9380, Z = -10 for P-256)
+SSWU_Z = -10 % curve.p
+SSWU_C1 = -curve.b * inverse_mod(curve.a, curve.p) % curve.p # -B / A
+SSWU_C2 = curve.b * inverse_mod(SSWU_Z * curve.a, curve.p) % curve.p # B / (Z * A)
+
+def getPointSSWU(u):
+    """ Maps the field element u (mod p) to a point on the elliptic curve with
+    the simplified SWU map. Unlike getPoint there is no search loop: every
+    input costs the same three exponentiations and one inversion. """
+    p = curve.p
+    u = u % p
+
+    tv1 = (SSWU_Z * SSWU_Z * pow(u, 4, p) + SSWU_Z * u * u) % p
+    if tv1 == 0:
+        x1 = SSWU_C2
+    else:
+        x1 = SSWU_C1 * (1 + inverse_mod(tv1, p)) % p
+    gx1 = (x1 * x1 * x1 + curve.a * x1 + curve.b) % p
+    x2 = SSWU_Z * u * u * x1 % p
+    gx2 = (x2 * x2 * x2 + curve.a * x2 + curve.b) % p
+
+    y1 = pow(gx1, (p + 1) // 4, p)
+    y2 = pow(gx2, (p + 1) // 4, p)
+    if y1 * y1 % p == gx1:
+        x, y = x1, y1
+    else:
+        x, y = x2, y2
+
+    # Fix the sign of y to match u
+    if (u & 1) != (y & 1):
+        y = p - y
+
+    return Point(x, y)
+
+
+
+# Selectable hash-to-curve methods, all taking an integer
+HASH_TO_CURVE = {
+    'cipolla': getPoint,
+    'sqrt': getPointSqrt,
+    'sswu': getPointSSWU,
+}
+
+
+
 def setup():
     return curve
 
@@ -289,7 +743,7 @@ def test():
     rho_inverse = inverse_mod(rho, curve.n)
     h_prime = scalar_mult(rho_inverse, z)
 
-    print("h       ", h[0])
-    print("c       ", c[0])
-    print("z       ", z[0])
-    print("h_prime ", h_prime[0])
+    print("h       ", h.x)
+    print("c       ", c.x)
+    print("z       ", z.x)
+    print("h_prime ", h_prime.x)
@@ -1,16 +1,28 @@
 ############################
 # Written by Logan Praneis #
 ############################
-from math import factorial
+import collections
+import metrics
 from .znUtil import *
 from .znUtil import DEBUG as DEBUG
 
+# N, e - RSA verification key; v, vki - Shoup verification keys for the shares
+VerKey = collections.namedtuple('VerKey', 'N e v vki')
+
+PROOF_BITS = 128 # L1 in Shoup, length of proof challenges
+BATCH_BITS = 64  # length of the random weights used by verifyParts and checkTokens
+# Shortest public exponent for which verifyBatch checks tokens together. Below
+# this (measured at 1024 bits) the weighted multiexp costs more than pow by e
+BATCH_MIN_E_BITS = 48
+
 def genshare(n, t, pp):
     """ Generate shares
     :param: n - number of parties
     :param: t - threshold
     :param: pp - public parameters
-    :returns: (shares, vki) tuple, where shares, vk are individual lists
+    :returns: (shares, vk) tuple
+        each share is (i, shareExponent(s_i)), ready for partEval
+        vk is a `VerKey`, with vki[i-1] = v^(s_i mod m)
     """
     delta, G = pp
     # Generate Polynomaial as [d, d1, d2, ..., dt] where di in Zm
@@ -22,26 +34,55 @@ def genshare(n, t, pp):
         poly = [G.d] +  [G.random(G.m) for i in range(1, t)]
 
     # Evaluate the polynomial at n points (not including 0, as that would be d
-    shares = [(i, int(evaluate(poly, i, G.m))) for i in range(1, n+1)]
-    # Generate verification keys
-    vki = [pow(G.v, s[1], G.N) for s in shares]
-    vk = (G.N, G.e)
-    # return shares, vki
+    shares = list(enumerate(evaluateAll(poly, n, G.m), 1))
+
+    # Hand out the reduced exponents rather than the raw polynomial values
+    shares = [(i, shareExponent(s, pp)) for (i, s) in shares]
+
+    # Generate verification keys for the exponents actually used
+    vki = fixedBasePow(G.v, [s[1] // 4 for s in shares], G.N)
+    vk = VerKey(N=G.N, e=G.e, v=G.v, vki=tuple(vki))
     return shares, vk
 
 
-def setup(k, n, t):
+def shareExponent(ski, pp):
+    """ Normalize a share to the exponent partEval raises H(x) to
+    :param: ski - share, polynomial evaluated at i
+    :param: pp - public parameters
+
+    :returns: 4 * (ski mod m)
+
+    Shoup deals 4 * delta * ski with delta = n!, so that the Lagrange
+    coefficients become integers. lamb_coeffs makes them integers per signer
+    subset instead, so no delta is dealt. Every w in Zn* has order dividing
+    2m, so w^4 lies in Qn (order m) and the exponent can be reduced:
+    w^(4 * ski) = (w^4)^(ski mod m). The result is at most |m| + 2 bits wide
+    for any n.
+    """
+    delta, G = pp
+    return 4 * (ski % G.m)
+
+
+def setup(k, n, t, G=None):
     ''' Setup Values
-    :param:k - length of primes in bits {512, 1024, 2048}
+    :param:k - length of primes in bits, new safe primes are generated
+        for sizes other than {512, 1024, 2048}
     :param:n - number of authorities
     :param:t - threshold parameter
+    :param:G `optional` - prebuilt `Zn` parameters, e.g. Zn(n, k, fresh=True).
+        Its dealer secrets are dropped, so it can only be dealt from once
 
     :returns: (shares, vk, pp) tuple
     '''
-    G = Zn(n, k)
-    delta = factorial(n)
+    if G is None:
+        G = Zn(n, k)
+    # pp keeps the factor the dealt shares carry, which combine() divides
+    # out. It is 1 here (see shareExponent), key files from before hold n!
+    delta = 1
     pp = delta, G
     shares, vk = genshare(n, t, pp)
+    # Nothing after dealing needs the factorization or d
+    G.dropSecrets()
     return shares, vk, pp
 
 
@@ -50,7 +91,7 @@ def setup(k, n, t):
 def partEval(sk_i, vk, x, pp):
     '''
     Evaluate a single share 
-    :param: sk_i - (i, sk) tuple for share
+    :param: sk_i - (i, sk) tuple for share, sk from shareExponent()
     :param: vk - verification key
     :param: x - bytestring message (password)
     :param: pp - public parameters
@@ -58,14 +99,131 @@ def partEval(sk_i, vk, x, pp):
     '''
     delta, G = pp
     w = G.hash(x)
-    i, ski = sk_i
+    i, signVal = sk_i
+    if metrics.ENABLED:
+        metrics.count('modexp')
 
-    # Using 4 * delta * ski now to find in Qn
-    # Also, this saves from scaling lambda coefficient later
-    signVal = 4 * delta * ski
+    # signVal = 4 * ski reduced by shareExponent, so y_i is in Qn
     return (i, pow(w, signVal,  G.N))
+
+
+def partEvalBatch(sk_i, vk, xs, pp):
+    '''
+    Evaluate a single share on many messages
+    :param: sk_i - (i, sk) tuple for share, sk from shareExponent()
+    :param: vk - verification key
+    :param: xs - list of bytestring messages
+    :param: pp - public parameters
+    :returns: list of (i, y_i) tuples, in the same order as xs
+    '''
+    delta, G = pp
+    i, signVal = sk_i
+    if metrics.ENABLED:
+        metrics.count('modexp', len(xs))
+
+    return [(i, pow(w, signVal, G.N)) for w in G.hashMany(xs)]
     
 
+def proofChallenge(G, vi, xt, xi, vprime, xprime):
+    '''
+    Fiat-Shamir challenge for a partial token proof, H'(v, xt, vi, xi, v', x')
+    :param: G - `Zn` parameters
+    :returns: PROOF_BITS bit integer
+    '''
+    size = (G.N.bit_length() + 7) // 8
+    b = SHAKE256.new()
+    for val in (G.v, xt, vi, xi, vprime, xprime):
+        b.update((val % G.N).to_bytes(size, 'big'))
+    return int.from_bytes(b.read(PROOF_BITS // 8), 'big')
+
+
+def partEvalProof(sk_i, vk, x, pp, y_i=None):
+    '''
+    Prove that a partial token is correct (Shoup p.215), i.e. that
+    log_xt(y_i) = log_v(vki) for xt = H(x)^4
+    :param: sk_i - (i, sk) tuple for share, sk from shareExponent()
+    :param: vk - `VerKey` verification key
+    :param: x - bytestring message (password)
+    :param: pp - public parameters
+    :param: y_i `optional` - (i, y_i) from partEval, recomputed if not given
+    :returns: (v', x', z) proof, checked by verifyParts()
+    '''
+    delta, G = pp
+    i, signVal = sk_i
+    s = signVal // 4
+
+    if metrics.ENABLED:
+        metrics.count('modexp', 3 if y_i else 4)
+    xt = pow(G.hash(x), 4, G.N)
+    xi = y_i[1] if y_i else pow(xt, s, G.N)
+
+    r = G.random(1 << (G.N.bit_length() + 2 * PROOF_BITS))
+    vprime = pow(G.v, r, G.N)
+    xprime = pow(xt, r, G.N)
+    c = proofChallenge(G, vk.vki[i-1], xt, xi, vprime, xprime)
+    z = c * s + r
+    return (vprime, xprime, z)
+
+
+def checkProofs(parts, proofs, vk, xt, G):
+    '''
+    Check partial token proofs together with one random linear combination
+    :param: parts - list of (i, y_i) tuples
+    :param: proofs - list of (v', x', z) proofs, in the same order as parts
+    :param: vk - `VerKey` verification key
+    :param: xt - H(x)^4
+    :param: G - `Zn` parameters
+    :returns: True if every proof verifies (except with probability 2^-BATCH_BITS)
+    '''
+    # Each proof claims v^z = v' * vki^c and xt^z = x' * y_i^c. With random
+    # weights d, g these fold into
+    #   v^(sum d*z) * xt^(sum g*z) * prod(v'^-d * vki^-dc * x'^-g * y_i^-gc) = 1
+    bases, exps = [G.v, xt], [0, 0]
+    for (i, xi), (vprime, xprime, z) in zip(parts, proofs):
+        if not 1 <= i <= len(vk.vki):
+            return False
+        if not all(0 < val < G.N for val in (xi, vprime, xprime)) or z < 0:
+            return False
+        vi = vk.vki[i-1]
+        c = proofChallenge(G, vi, xt, xi, vprime, xprime)
+        d = randrange(1, 1 << BATCH_BITS)
+        g = randrange(1, 1 << BATCH_BITS)
+        exps[0] += d * z
+        exps[1] += g * z
+        bases += [vprime, vi, xprime, xi]
+        exps += [-d, -d * c, -g, -g * c]
+
+    # Squaring both sides removes any component of order 2
+    try:
+        return multiexp(bases, [2 * e for e in exps], G.N) == 1
+    except ValueError:
+        # some value was not invertible mod N
+        return False
+
+
+def verifyParts(parts, proofs, vk, x, pp):
+    '''
+    Batch verify partial tokens before running combine()
+    :param: parts - list of (i, y_i) tuples from partEval
+    :param: proofs - list of proofs from partEvalProof, in the same order as parts
+    :param: vk - `VerKey` verification key
+    :param: x - bytestring message (password)
+    :param: pp - public parameters
+    :returns: list of indices i whose partial token is wrong, empty if all are valid
+    '''
+    delta, G = pp
+    if metrics.ENABLED:
+        metrics.count('modexp')
+    xt = pow(G.hash(x), 4, G.N)
+
+    if checkProofs(parts, proofs, vk, xt, G):
+        return []
+
+    # Something is wrong, find out which ones
+    return [part[0] for part, proof in zip(parts, proofs)
+            if not checkProofs([part], [proof], vk, xt, G)]
+
+
 def combine(sd, pp, t, x):
     '''
     Combine all shares
@@ -90,34 +248,30 @@ def combine(sd, pp, t, x):
     inds, vals = zip(*sd)
     inds, vals = list(inds), list(vals)
 
-    w = 1
-    for i in range(len(inds)):
-        l = lamb_coeff(inds[i], inds, delta)
-        if l < 0:
-            w *=  pow(inverse(vals[i], G.N), -1 * l,   G.N)
-        else: 
-            w *= pow(vals[i], l, G.N)
-    w = w % G.N
-    
-    eprime = 4 * (delta ** 2)
-    a, b = egcd(eprime,  G.e) 
-    # assert( (a * 4 * delta**2 + b* G.e ) % G.N == 1)
+    # Coefficients only depend on the subset, so look them up by sorted indices
+    S = tuple(sorted(inds))
+    coeffs, eprime, (a, b) = lamb_coeffs(S, delta, G.e)
+    lambs = dict(zip(S, coeffs))
+
+    # w = prod(vals[i] ** (2 * lambda_i)), negative coefficients share one inversion
+    # Squaring (as in Shoup) makes a partial token multiplied by an element of
+    # order 2 harmless; the proofs in verifyParts only pin down y_i^2
+    w = multiexp(vals, [2 * lambs[i] for i in inds], G.N)
+
+    # assert( (a * eprime + b* G.e ) == 1)
 
     hashed = G.hash(x)
 
-    # Equality on bottom on p.215  
-    lhs = (pow(w, G.e, G.N))
-    rhs = (pow(hashed, eprime, G.N))
     if (DEBUG):
-         print('Equal?', lhs == rhs)
+        # Equality on bottom on p.215  
+        lhs = (pow(w, G.e, G.N))
+        rhs = (pow(hashed, eprime, G.N))
+        print('Equal?', lhs == rhs)
 
-    if a < 0:
-        tk = (pow(inverse(w, G.N), -1 *a, G.N) * pow(hashed, b, G.N))
-    else:
-        tk = (pow(w, a, G.N) * pow(inverse(hashed, G.N),  -1 * b, G.N))
-            
+    # tk = w^a * H(x)^b, with whichever of a, b is negative inverted
+    tk = multiexp([w, hashed], [a, b], G.N)
     
-    return tk % G.N
+    return tk
 
 
 
@@ -133,6 +287,8 @@ def verify(vk, x, tk, pp):
         False - tk is not valid for x
     '''
     delta, G = pp
+    if metrics.ENABLED:
+        metrics.count('modexp')
     lhs = pow(tk, G.e, G.N) 
     rhs = G.hash(x) % G.N
     if (DEBUG):
@@ -140,6 +296,78 @@ def verify(vk, x, tk, pp):
         print('rhs', rhs)
     return (lhs == rhs)
 
+
+def checkTokens(hashes, tks, G):
+    '''
+    Check tokens together with the small exponents test
+    :param: hashes - list of H(x) values
+    :param: tks - list of tokens, in the same order as hashes
+    :param: G - `Zn` parameters
+    :returns: True if tk^e = ±H(x) for every pair (except with probability
+        2^-BATCH_BITS)
+    '''
+    # prod(tk^r)^e = prod(H(x)^r) for random weights r, so e is applied once.
+    # Squaring removes the sign, which the weights only catch half of the time
+    tks = [tk % G.N for tk in tks]
+    if not all(tks):
+        return False
+    weights = [randrange(1, 1 << BATCH_BITS) for _ in tks]
+    if metrics.ENABLED:
+        metrics.count('modexp', 2)
+    lhs = pow(multiexp(tks, weights, G.N), 2 * G.e, G.N)
+    rhs = pow(multiexp(hashes, weights, G.N), 2, G.N)
+    return lhs == rhs
+
+
+def batchScreens(G):
+    '''
+    True if verifyBatch() checks tokens together for these parameters, so a
+    token it passes is only known to satisfy tk^e = ±H(x)
+    :param: G - `Zn` parameters
+    '''
+    return G.e.bit_length() >= BATCH_MIN_E_BITS
+
+
+def verifyBatch(vk, xs, tks, pp):
+    '''
+    Verify many tokens at once
+    With a public exponent of BATCH_MIN_E_BITS or more, tokens are checked
+    together with checkTokens() and a failing batch is split in halves to find
+    the bad tokens. This screens rather than verifies: N - tk passes wherever
+    tk does, which is no forgery as anyone can negate a token. Smaller
+    exponents (as from Zn) make pow(tk, e, N) cheaper than the weights, so
+    each token is checked on its own as in verify().
+    :param: vk - verification key
+    :param: xs - list of bytestring messages
+    :param: tks - list of tokens, in the same order as xs
+    :param: pp - public parameters
+    :returns: list of positions j whose token is not valid for xs[j], empty if all are valid
+    '''
+    delta, G = pp
+    hashes = G.hashMany(xs)
+
+    def single(j):
+        if metrics.ENABLED:
+            metrics.count('modexp')
+        return pow(tks[j], G.e, G.N) == hashes[j]
+
+    if not batchScreens(G):
+        return [j for j in range(len(tks)) if not single(j)]
+
+    bad = []
+    def bisect(js):
+        if len(js) == 1:
+            if not single(js[0]):
+                bad.append(js[0])
+        elif not checkTokens([hashes[j] for j in js], [tks[j] for j in js], G):
+            half = len(js) // 2
+            bisect(js[:half])
+            bisect(js[half:])
+
+    if tks:
+        bisect(list(range(len(tks))))
+    return bad
+
 def test():
 
     # testing utility, should output true!
@@ -4,27 +4,49 @@
 from Crypto.Util.number import getPrime, inverse, isPrime, GCD
 from Crypto.Hash import BLAKE2b, SHAKE256
 from binascii import hexlify
-from Crypto.Random.random import randrange
+from Crypto.Random.random import randrange, getrandbits
+from functools import lru_cache
+from fractions import Fraction
+from math import lcm
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import os
+import metrics
+import time
+from top.TOP import batch_inverse_mod
 
 
 DEBUG = False
 
+# Number of signer subsets whose Lagrange coefficients are kept by lamb_coeffs.
+# Use lamb_coeffs.cache_info() for the hit/miss counters when sizing this.
+LAMBDA_CACHE_SIZE = 128
+
+# Number of H(x) values kept by hashToZn, so partEval, combine and verify in
+# one process hash each message once. hashToZn.cache_info() has the counters.
+HASH_CACHE_SIZE = 1024
+
+# Extra hash output beyond the size of N, so that reducing mod N is unbiased
+HASH_EXTRA_BITS = 128
+
 class Zn:
-    def __init__(self, n, bits=512):
+    def __init__(self, n, bits=512, fresh=False, workers=None, deadline=None, progress=None):
         """
         :param: n - threshold
         :param: `optional` bits - # bits in prime, default 512
+        :param: `optional` fresh - generate new safe primes even for 512, 1024
+            and 2048 bits, instead of the built-in ones
+        :param: `optional` workers, deadline, progress - passed to genSafePrime
+            when new primes are generated (deadline covers both primes)
         """
         self.bits = bits
-        if self.bits == 512:
+        if fresh or self.bits not in (512, 1024, 2048):
+            self.generated_key_parameters(bits, workers, deadline, progress)
+        elif self.bits == 512:
             self.static_512_key_parameters()
         elif self.bits == 1024:
             self.static_1024_key_parameters()
         elif self.bits == 2048:
             self.static_2048_key_parameters()
-        else:
-            print('{} not accepted, using 512 bit keys'.format(bits))
-            self.static_512_key_parameters()
 
         # self.e = getPrime(512)
         self.N = self.p * self.q
@@ -44,6 +66,20 @@ class Zn:
         # assert((self.d * self.e) % self.m == 1)
 
 
+    def generated_key_parameters(self, bits, workers=None, deadline=None, progress=None):
+        """ Generate two new safe primes p = 2p' + 1, q = 2q' + 1 of bits bits """
+        end = None if deadline is None else time.time() + deadline
+
+        p = genSafePrime(bits, workers, deadline, progress)
+        q = p
+        while q == p:
+            remaining = None if end is None else max(0, end - time.time())
+            q = genSafePrime(bits, workers, remaining, progress)
+
+        pp, qp = (p - 1) // 2, (q - 1) // 2
+        m = qp * pp
+        self.p, self.q, self.m = p, q,  m
+
     def static_512_key_parameters(self):
         
         p =14803816792137194961464740500861084314498273884502062848972100269359945855258103338378053276309214964458559920121618145541357486576747004424971736904458523
@@ -81,6 +117,41 @@ class Zn:
         m = qp * pp
         self.p, self.q, self.m = p, q,  m
 
+    # Public attributes, the only ones saved by toDict and loaded by fromDict
+    FIELDS = ('bits', 'N', 'v', 'e')
+    # The factorization of N and the signing exponent d. Only the dealer needs
+    # them, anyone holding them can make tokens without the servers
+    SECRETS = ('p', 'q', 'm', 'totient', 'd')
+
+    def dropSecrets(self):
+        """
+        Forget the SECRETS once the shares have been dealt, see shoup.setup
+        """
+        for name in Zn.SECRETS:
+            if hasattr(self, name):
+                delattr(self, name)
+
+    def toDict(self):
+        """
+        :returns: dict of the public parameters in FIELDS, for saving to disk
+        """
+        return {name: getattr(self, name) for name in Zn.FIELDS if hasattr(self, name)}
+
+    @classmethod
+    def fromDict(cls, params):
+        """
+        Rebuild public parameters saved with toDict, without generating anything.
+        The result has no SECRETS, so it can verify and combine but not deal
+        :param: params - dict from toDict
+        :returns: Zn instance
+        """
+        G = cls.__new__(cls)
+        for name, value in params.items():
+            if name not in Zn.FIELDS:
+                raise ValueError('unknown Zn field {}'.format(name))
+            setattr(G, name, value)
+        return G
+
     @staticmethod
     def random(x):
         """
@@ -94,15 +165,14 @@ class Zn:
         :param: x (bytestring) : value to hash
         :returns: H(x): x hashed into Zn*
         """
+        return hashToZn(self.N, x)
 
-        b = SHAKE256.new()
-        b.update(x)
-
-        # reading the bitlength of parameter +1 from hash
-        length = int.bit_length(self.N) + 1
-        h = int(hexlify(b.read(length)), 16) % self.N
-        # calculaitng h in Zn
-        return h
+    def hashMany(self, xs):
+        """
+        :param: xs (list of bytestrings) : values to hash
+        :returns: [H(x) for x in xs]
+        """
+        return [hashToZn(self.N, x) for x in xs]
 
     def hashSign(self , m, vi,  l1, delta, si):
         # Not used currently, but could be used to verify token parts are valid
@@ -138,6 +208,135 @@ class Zn:
 
 
 
+@lru_cache(maxsize=HASH_CACHE_SIZE)
+def hashToZn(N, x):
+    """ SHAKE256 of x reduced into Zn, memoized per (N, x)
+    :param: N - modulus, identifies the public parameters
+    :param: x - bytestring to hash
+    :returns: H(x), integer in Zn
+    """
+    b = SHAKE256.new()
+    b.update(x)
+
+    # bits of N plus a margin, in bytes
+    length = (N.bit_length() + HASH_EXTRA_BITS + 7) // 8
+    return int.from_bytes(b.read(length), 'big') % N
+
+
+
+def smallPrimes(bound):
+    """ Sieve of Eratosthenes
+    :param: bound - int
+    :returns: list of primes below bound
+    """
+    flags = bytearray([1]) * bound
+    flags[0:2] = b'\x00\x00'
+    for r in range(2, int(bound ** 0.5) + 1):
+        if flags[r]:
+            flags[r*r::r] = bytes(len(range(r*r, bound, r)))
+    return [r for r in range(bound) if flags[r]]
+
+SIEVE_PRIMES = smallPrimes(1 << 14)[1:] # odd primes used to sieve safe prime candidates
+SIEVE_WINDOW = 4096 # candidates q' per window handed to a worker
+
+
+
+def sieveWindow(start, size):
+    """ Sieve safe prime candidates q' = start + 2j, j in [0, size)
+    :param: start - odd integer
+    :param: size - number of candidates
+    :returns: list of q' for which neither q' nor 2q' + 1 has a small factor
+    """
+    flags = bytearray([1]) * size
+    for r in SIEVE_PRIMES:
+        inv2 = (r + 1) // 2
+        # q' = 0 (mod r) and 2q' + 1 = 0 (mod r), i.e. q' = (r - 1) / 2 (mod r)
+        for target in (0, (r - 1) // 2):
+            j = (target - start) * inv2 % r
+            flags[j::r] = bytes(len(range(j, size, r)))
+    return [start + 2 * j for j in range(size) if flags[j]]
+
+
+
+def searchWindow(bits, start, size=SIEVE_WINDOW):
+    """ Look for a safe prime in one sieved window (runs in a worker process)
+    :param: bits - size of the safe prime p
+    :param: start - odd q' to start from, (bits - 1) bits long
+    :param: size - number of candidates
+    :returns: (p, tested) - p = 2q' + 1 or None, and the number of candidates tested
+    """
+    tested = 0
+    for qp in sieveWindow(start, size):
+        tested += 1
+        p = 2 * qp + 1
+        if p.bit_length() != bits:
+            break
+        # Cheap Fermat tests first, most candidates fail one of them
+        if pow(2, qp - 1, qp) != 1 or pow(2, p - 1, p) != 1:
+            continue
+        if isPrime(qp) and isPrime(p):
+            return p, tested
+    return None, tested
+
+
+
+def genSafePrime(bits, workers=None, deadline=None, progress=None):
+    """ Generate a random safe prime p = 2p' + 1, p' prime
+    Random windows of candidates are sieved and tested in parallel.
+    :param: bits - size of p in bits
+    :param: `optional` workers - number of processes, default all cores
+    :param: `optional` deadline - seconds before giving up with TimeoutError
+    :param: `optional` progress - called as progress(tested, elapsed) after
+        every window
+    :returns: p
+    """
+    # q' must be larger than every sieving prime
+    if bits < 32:
+        raise ValueError('{} bits is too small for a safe prime'.format(bits))
+
+    workers = workers or os.cpu_count() or 1
+    began = time.time()
+    tested = 0
+
+    def randomStart():
+        # top two bits set, so the product of two such primes has 2 * bits bits
+        return getrandbits(bits - 1) | (3 << (bits - 3)) | 1
+
+    def report(count):
+        if progress:
+            progress(count, time.time() - began)
+
+    def expired():
+        return deadline is not None and time.time() - began > deadline
+
+    if workers == 1:
+        while not expired():
+            p, count = searchWindow(bits, randomStart())
+            tested += count
+            report(tested)
+            if p:
+                return p
+        raise TimeoutError('no safe prime found in {}s'.format(deadline))
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        pending = {pool.submit(searchWindow, bits, randomStart()) for _ in range(workers)}
+        while not expired():
+            timeout = None if deadline is None else max(0, deadline - (time.time() - began))
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                p, count = future.result()
+                tested += count
+                report(tested)
+                if p:
+                    return p
+                pending.add(pool.submit(searchWindow, bits, randomStart()))
+        raise TimeoutError('no safe prime found in {}s'.format(deadline))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+
 def evaluate(poly, x, p=None):
     """ Evaluate a polynomial in Zp*
     :param: poly - list of polynomail coefficients
@@ -145,35 +344,169 @@ def evaluate(poly, x, p=None):
     :param: p `optional` - prime
     :returns: p(x), integer in Zp*
     """
-    evaluated = ((poly[j] * pow(x, j)) for j in range(len(poly)))
-    if p:
-        return sum(evaluated) % p
-    else:
-        return sum(evaluated) 
-
+    # Horner's rule, reducing at every step so values stay below p * x
+    result = 0
+    for coeff in reversed(poly):
+        result = result * x + coeff
+        if p:
+            result %= p
+    return result
 
 
-def lamb_coeff(i,  S, delta):
-    """ Compute lagrage interpolation, as shown in Shoup
-    :param: i - point in S
-    :param: S - set of k points in {0, 1, ..., n}
-    :param: delta - n!
 
-    :returns: lagrange interpolation at 0, scaled
+def evaluateAll(poly, n, p=None):
+    """ Evaluate a polynomial at every point 1, 2, ..., n in Zp*
+    After the first len(poly) points, each further point only costs
+    len(poly) - 1 additions (forward differences) instead of a Horner pass.
+    :param: poly - list of polynomail coefficients
+    :param: n - number of points
+    :param: p `optional` - prime
+    :returns: [p(1), ..., p(n)]
     """
-    v = delta
-    # Construct Numerator
-    for e in S:
-        if e  != i:
-            v*= e
-
+    d = len(poly) - 1
+    values = [evaluate(poly, x, p) for x in range(1, min(n, d + 1) + 1)]
+    if n <= d + 1:
+        return values
+
+    # diffs[k] = k-th forward difference at x = 1
+    diffs = list(values)
+    for k in range(1, d + 1):
+        for j in range(d, k - 1, -1):
+            diffs[j] = diffs[j] - diffs[j - 1]
+            if p:
+                diffs[j] %= p
+
+    for x in range(2, n + 1):
+        # step every difference from x - 1 to x
+        for k in range(d):
+            diffs[k] = diffs[k] + diffs[k + 1]
+            if p:
+                diffs[k] %= p
+        if x > d + 1:
+            values.append(diffs[0])
+    return values
+
+
+
+def multiexp(bases, exps, N):
+    """ Simultaneous multi-exponentiation (Straus / Shamir interleaving)
+    Negative exponents are handled by inverting their bases, with one shared
+    inversion for all of them.
+    :param: bases - list of integers in Zn*
+    :param: exps - list of (possibly negative) integer exponents
+    :param: N - modulus
+    :returns: prod(bases[i] ** exps[i]) mod N
+    """
+    if metrics.ENABLED:
+        metrics.count('multiexp')
+    neg = [j for j in range(len(exps)) if exps[j] < 0]
+    bases = [b % N for b in bases]
+    exps = list(exps)
+    for j, b_inv in zip(neg, batch_inverse_mod([bases[j] for j in neg], N, inverse)):
+        bases[j] = b_inv
+        exps[j] = -exps[j]
+
+    L = max([e.bit_length() for e in exps] + [0])
+    if L == 0:
+        return 1 % N
+
+    # window width, growing slowly with the exponent length
+    w = max(1, min(5, L.bit_length() - 3))
+    mask = (1 << w) - 1
+
+    # tables[j][d] = bases[j] ** d for d in [0, 2^w)
+    tables = []
+    for b in bases:
+        table = [1, b]
+        for _ in range(2, 1 << w):
+            table.append(table[-1] * b % N)
+        tables.append(table)
+
+    result = 1
+    for shift in range(((L - 1) // w) * w, -1, -w):
+        if result != 1:
+            for _ in range(w):
+                result = result * result % N
+        for table, e in zip(tables, exps):
+            d = (e >> shift) & mask
+            if d:
+                result = result * table[d] % N
+
+    return result % N
+
+
+
+def fixedBasePow(g, exps, N, w=6):
+    """ Raise one base to many non-negative exponents mod N
+    Precomputes g^(d * 2^(w*j)) for every w-bit digit d and position j, after
+    which each exponent only costs one multiplication per non-zero digit and
+    no squarings. Worth it from roughly a dozen exponents on.
+    :param: g - base
+    :param: exps - list of exponents >= 0
+    :param: N - modulus
+    :param: `optional` w - digit width
+    :returns: [g^e mod N for e in exps]
+    """
+    if len(exps) < 12:
+        return [pow(g, e, N) for e in exps]
+
+    L = max(e.bit_length() for e in exps)
+    mask = (1 << w) - 1
+    table = []
+    b = g % N
+    for _ in range((L + w - 1) // w):
+        row = [1, b]
+        for _ in range(2, 1 << w):
+            row.append(row[-1] * b % N)
+        table.append(row)
+        b = row[-1] * b % N
+
+    result = []
+    for e in exps:
+        r = 1
+        for row in table:
+            if not e:
+                break
+            d = e & mask
+            if d:
+                r = r * row[d] % N
+            e >>= w
+        result.append(r % N)
+    return result
+
+
+
+@lru_cache(maxsize=LAMBDA_CACHE_SIZE)
+def lamb_coeffs(S, delta, e):
+    """ Lagrange coefficients for a whole signer subset, cached by subset
+    :param: S - sorted tuple of the participating indices
+    :param: delta - factor the dealt shares carry, 1 for shares from
+        shoup.genshare, n! in key files dealt before it stopped scaling them
+    :param: e - RSA public exponent, a prime > n
+
+    :returns: (coeffs, eprime, (a, b))
+        coeffs - D * L_i(0) for i in S, in the order of S
+        eprime - 8 * delta * D, the exponent combine() ends up with
+        (a, b) - egcd(eprime, e)
+
+    Shoup scales the shares, and with them every coefficient, by delta = n!,
+    which makes eprime = 4 * delta^2 and the Bezout pair grow like log(n!).
+    Here D is the smallest integer that makes all L_i(0) integral for this
+    subset. Its prime factors are differences of indices, so D has about
+    t * log(n) bits and stays coprime to e, and eprime = 8 * D for shares
+    dealt without delta (see shoup.shareExponent).
+    """
+    L = [Fraction(1)] * len(S)
+    for k, i in enumerate(S):
+        for j in S:
+            if j != i:
+                L[k] *= Fraction(j, j - i)
+    D = lcm(*[l.denominator for l in L])
+    coeffs = tuple(int(l * D) for l in L)
 
-    # Construct Denominator
-    for e in S:
-        if e != i:
-            v //= (e - i)
+    eprime = 8 * delta * D
+    return coeffs, eprime, egcd(eprime, e)
 
-    return v
 
 
 def egcd(a, b):
@@ -0,0 +1,199 @@
+# Binary wire format for the messages pasta.py exchanges between the client
+# and the servers. Every frame starts with a version byte and a type byte.
+#
+#   request : ver | REQUEST  | C (32)   | point (33)
+#   response: ver | RESPONSE | flags    | zi (33) | nonce (16) | tag (16) | ct (size)
+#             [ v' (size) | x' (size) | len(z) (2) | z ]       if flags & FLAG_PROOF
+#   token   : ver | TOKEN    | tk (size)
+#   record  : ver | RECORD   | C (32)   | hi (32)
+#
+# Points are SEC1 compressed, integers are big-endian and sized to N
+# (size = intSize(N)), so nothing goes through decimal strings. Decoders take
+# bytes or a memoryview and only slice views of it. They raise ValueError on
+# malformed input.
+import top.TOP as top
+
+WIRE_VERSION = 1
+
+# Frame types
+REQUEST = 1
+RESPONSE = 2
+TOKEN = 3
+RECORD = 4
+
+# Response flags
+FLAG_PROOF = 1
+
+ID_SIZE = 32 # client IDs are SHA-256 digests
+KEY_SIZE = 32 # record keys hi are SHA-256 digests
+NONCE_SIZE = 16
+TAG_SIZE = 16
+
+REQUEST_SIZE = 2 + ID_SIZE + top.POINT_SIZE
+RECORD_SIZE = 2 + ID_SIZE + KEY_SIZE
+
+
+def intSize(N):
+    ''' Number of bytes of a fixed-width integer mod N '''
+    return (N.bit_length() + 7) // 8
+
+def encodeInt(v, size):
+    ''' Fixed-width big-endian encoding of 0 <= v < 2^(8 * size) '''
+    return v.to_bytes(size, 'big')
+
+def decodeInt(data):
+    ''' Inverse of encodeInt() '''
+    return int.from_bytes(data, 'big')
+
+def checkHeader(view, kind):
+    if len(view) < 2 or view[0] != WIRE_VERSION:
+        raise ValueError('unsupported wire version')
+    if view[1] != kind:
+        raise ValueError('unexpected frame type {}'.format(view[1]))
+
+##########################################################################################
+#
+# Requests
+#
+##########################################################################################
+
+def encodeRequest(C, point):
+    ''' Frame a login request
+    ``Args:``
+        C: (int) Client ID
+        point: (`top.Point`) blinded password point
+    ``Returns``
+        (bytes) request frame
+    '''
+    return b''.join((bytes((WIRE_VERSION, REQUEST)),
+                     encodeInt(C, ID_SIZE),
+                     top.point_to_bytes(point)))
+
+def decodeRequest(data):
+    ''' Parse a request frame
+    ``Returns``
+        C: (int) Client ID
+        point: (`top.Point`) request point, on the curve by construction
+    '''
+    view = memoryview(data)
+    checkHeader(view, REQUEST)
+    if len(view) != REQUEST_SIZE:
+        raise ValueError('bad request length')
+    C = decodeInt(view[2:2 + ID_SIZE])
+    point = top.point_from_bytes(view[2 + ID_SIZE:])
+    return C, point
+
+##########################################################################################
+#
+# Responses
+#
+##########################################################################################
+
+def encodeResponse(zi, nonce, tag, ct, size, proof=None):
+    ''' Frame a server response
+    ``Args:``
+        zi: (`top.Point`) ki * request
+        nonce, tag, ct: (bytes) AES-EAX encryption of the partial token
+        size: (int) intSize(N)
+        proof: (tuple) `optional` (v', x', z) from shoup.partEvalProof
+    ``Returns``
+        (bytes) response frame
+    '''
+    if len(ct) != size:
+        raise ValueError('ciphertext must be intSize(N) bytes')
+    parts = [bytes((WIRE_VERSION, RESPONSE, FLAG_PROOF if proof else 0)),
+             top.point_to_bytes(zi), nonce, tag, ct]
+    if proof:
+        vprime, xprime, z = proof
+        zlen = intSize(z)
+        parts += [encodeInt(vprime, size), encodeInt(xprime, size),
+                  zlen.to_bytes(2, 'big'), encodeInt(z, zlen)]
+    return b''.join(parts)
+
+def decodeResponse(data, size):
+    ''' Parse a response frame
+    ``Args:``
+        data: (bytes) response frame
+        size: (int) intSize(N)
+    ``Returns``
+        zi: (`top.Point`) response point, on the curve by construction
+        nonce, tag, ct: (memoryview) AES-EAX fields
+        proof: (tuple) (v', x', z), or None if no proof is attached
+    '''
+    view = memoryview(data)
+    checkHeader(view, RESPONSE)
+    if len(view) < 3:
+        raise ValueError('bad response length')
+    flags = view[2]
+
+    pos = 3
+    end = pos + top.POINT_SIZE + NONCE_SIZE + TAG_SIZE + size
+    if len(view) < end:
+        raise ValueError('bad response length')
+    zi = top.point_from_bytes(view[pos:pos + top.POINT_SIZE])
+    pos += top.POINT_SIZE
+    nonce = view[pos:pos + NONCE_SIZE]
+    pos += NONCE_SIZE
+    tag = view[pos:pos + TAG_SIZE]
+    pos += TAG_SIZE
+    ct = view[pos:end]
+    pos = end
+
+    proof = None
+    if flags & FLAG_PROOF:
+        if len(view) < pos + 2 * size + 2:
+            raise ValueError('bad response length')
+        vprime = decodeInt(view[pos:pos + size])
+        xprime = decodeInt(view[pos + size:pos + 2 * size])
+        pos += 2 * size
+        zlen = decodeInt(view[pos:pos + 2])
+        pos += 2
+        if len(view) != pos + zlen:
+            raise ValueError('bad response length')
+        proof = (vprime, xprime, decodeInt(view[pos:]))
+    elif len(view) != pos:
+        raise ValueError('bad response length')
+
+    return zi, nonce, tag, ct, proof
+
+##########################################################################################
+#
+# Tokens
+#
+##########################################################################################
+
+def encodeToken(tk, size):
+    ''' Frame a token, size = intSize(N) '''
+    return bytes((WIRE_VERSION, TOKEN)) + encodeInt(tk, size)
+
+def decodeToken(data, size):
+    ''' Parse a token frame, size = intSize(N) '''
+    view = memoryview(data)
+    checkHeader(view, TOKEN)
+    if len(view) != 2 + size:
+        raise ValueError('bad token length')
+    return decodeInt(view[2:])
+
+##########################################################################################
+#
+# Records
+#
+##########################################################################################
+
+def encodeRecord(C, hi):
+    ''' Frame a client record for server i, hi as generated by signUp() '''
+    if len(hi) != KEY_SIZE:
+        raise ValueError('record key must be {} bytes'.format(KEY_SIZE))
+    return b''.join((bytes((WIRE_VERSION, RECORD)), encodeInt(C, ID_SIZE), hi))
+
+def decodeRecord(data):
+    ''' Parse a record frame
+    ``Returns``
+        C: (int) Client ID
+        hi: (bytes) record key
+    '''
+    view = memoryview(data)
+    checkHeader(view, RECORD)
+    if len(view) != RECORD_SIZE:
+        raise ValueError('bad record length')
+    return decodeInt(view[2:2 + ID_SIZE]), bytes(view[2 + ID_SIZE:])